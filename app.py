@@ -1,17 +1,65 @@
 import streamlit as st
 from PIL import Image
-import os
-import tempfile
-import atexit
-from geminigen import generate
-from grade import grade
-from graph import overlay_grid_on_image
-from utils import resize_image_width, fix_image_orientation
-from counter import read_counter, update_counter
+import base64
+import logging
+import time
+from grade import ProgressiveGrader, grade
+from utils import image_to_bytes, resize_image_width
+from cache import (
+    artifact_cache,
+    make_cache_key,
+    response_cache,
+    result_store,
+)
+from crop import (
+    CropNotFoundError,
+    crop_full_resolution,
+    detect_page,
+    make_proxy,
+    rect_corners,
+    region_iou,
+)
+from counter import check_health, get_mongo_timing, reset_mongo_timing
+from ingest import (
+    SUBMISSION_TYPES,
+    count_pages,
+    decode_upload,
+    grade_document,
+    is_pdf,
+)
+from jobs import FAILED, grading_jobs
+from pipeline import QuotaLedger, charge_to, model_flights
+from tiling import run_sheet
+from tracing import (
+    TRACE_HISTORY,
+    configure_logging,
+    recent_traces,
+    record_rerun,
+    rerun_stats,
+    start_trace,
+)
 import streamlit as st
 from streamlit_cropperjs import st_cropperjs
 from styles import load_css
 
+configure_logging()
+logger = logging.getLogger("app")
+
+# Streamlit re-executes this script on every interaction; main() records how
+# long each run took
+RERUN_START = time.perf_counter()
+
+# Seconds between checks on a running grading job
+JOB_POLL_SECONDS = 0.5
+# Width and JPEG quality of the small previews shown while cropping and grading
+PREVIEW_WIDTH = 400
+PREVIEW_QUALITY = 80
+# JPEG quality of the cropped and graded sheets kept for the results page
+CROP_QUALITY = 90
+# A speculative grading of the detected page is kept if the final crop overlaps
+# the page by at least this much (intersection over union)
+SPECULATIVE_MIN_IOU = 0.9
+
 # Set page configuration
 st.set_page_config(
     page_title="Homework Grader",
@@ -32,46 +80,79 @@ def grader_page():
     if not st.session_state.upload_complete:
         uploaded_file = st.file_uploader(
             "Drag and drop or click to upload homework image",
-            type=["jpg", "jpeg", "png"],
+            type=SUBMISSION_TYPES,
             label_visibility="collapsed",
             key="file_uploader",
         )
 
         if uploaded_file is not None:
-            # Clean old temp files before processing new ones
-            clean_temp_files()
-
-            # Create a temporary file to store the uploaded image
-            with tempfile.NamedTemporaryFile(
-                delete=False, suffix=f"_{uploaded_file.name}"
-            ) as tmp_file:
-                tmp_file.write(uploaded_file.getvalue())
-                input_image_path = tmp_file.name
-
-            # Add to temp files list for later cleanup
-            st.session_state.temp_files.append(input_image_path)
-
-            # Read image and fix orientation
-            input_image = Image.open(input_image_path)
-            fixed_image = fix_image_orientation(input_image)
-            fixed_image = resize_image_width(fixed_image, target_width=1024)
-            fixed_image.save(input_image_path)
-
-            # Update session state
-            st.session_state.original_image_path = input_image_path
+            upload_bytes = uploaded_file.getvalue()
+            if is_pdf(upload_bytes) or count_pages(upload_bytes) > 1:
+                # PDFs and multi-page TIFFs are graded page by page, uncropped
+                st.session_state.document_bytes = upload_bytes
+                st.session_state.upload_complete = True
+                st.session_state.cropping_complete = True
+                st.rerun()
+
+            # Decode straight from the upload buffer at the working width and
+            # fix orientation (JPEGs are never decoded at full resolution), then
+            # look for the page so it can be graded without cropping by hand
+            with start_trace("upload", upload_bytes=len(upload_bytes)):
+                decoded = decode_upload(upload_bytes, target_width=1024)
+                auto_crop = detect_page(decoded.image)
+
+            # Keep the working image on the server; the cropper only gets a
+            # small JPEG proxy of it
+            st.session_state.original_image = decoded.image
+            st.session_state.crop_proxy = make_proxy(decoded.image)
+            st.session_state.upload_key = make_cache_key(upload_bytes)
+            st.session_state.auto_crop = auto_crop
             st.session_state.upload_complete = True
+            if SPECULATIVE_GRADING and auto_crop.found:
+                start_speculative_grading(auto_crop.image)
             st.rerun()
 
     # Step 2: Crop Image (if upload is complete but cropping is not)
     elif st.session_state.upload_complete and not st.session_state.cropping_complete:
         st.markdown("### Step 2: Crop Homework Image")
+
+        # The page found at upload can be graded as is, without the cropper
+        auto_crop = st.session_state.auto_crop
+        if auto_crop is not None and auto_crop.found:
+            st.write("We found the page in your photo and straightened it:")
+            st.image(
+                cached_artifact(
+                    "auto_crop_preview",
+                    st.session_state.upload_key,
+                    lambda: preview_bytes(auto_crop.image),
+                ),
+                width=PREVIEW_WIDTH,
+                output_format="JPEG",
+            )
+            st.caption(f"Page detected in {auto_crop.detect_ms:.0f} ms")
+            if st.session_state.speculative_job is not None:
+                st.caption("Grading the detected page in the background...")
+            if st.button("Use Auto Crop", type="primary", use_container_width=True):
+                st.session_state.cropped_image = auto_crop.image
+                st.session_state.cropped_image_bytes = image_to_bytes(
+                    auto_crop.image, format="JPEG", quality=CROP_QUALITY
+                )
+                st.session_state.crop_region = auto_crop.corners
+                st.session_state.cropping_complete = True
+                st.rerun()
+            st.write("Or crop it yourself:")
+        elif auto_crop is not None:
+            st.caption(
+                f"No page edges found ({auto_crop.detect_ms:.0f} ms); "
+                "crop the sheet by hand."
+            )
+
         st.write(
             "Drag to select the area you want to crop, then click the 'Crop Image' button."
         )
 
-        # Read the image as bytes for cropperjs
-        with open(st.session_state.original_image_path, "rb") as file:
-            img_bytes = file.read()
+        # The cropper is sent the proxy made at upload, not the working image
+        proxy = st.session_state.crop_proxy
 
         # Display cropper with responsive container
         st.markdown(
@@ -81,49 +162,43 @@ def grader_page():
 
         # Mobile-optimized cropper
         cropped_pic = st_cropperjs(
-            pic=img_bytes, btn_text="Crop Image", key="homework_cropper", size=0.01
+            pic=proxy.data, btn_text="Crop Image", key="homework_cropper", size=0.01
         )
 
         st.markdown("</div>", unsafe_allow_html=True)
 
         if cropped_pic is not None:
-            # Save the cropped image
-            cropped_path = os.path.join(
-                tempfile.gettempdir(),
-                f"cropped_{os.path.basename(st.session_state.original_image_path)}",
-            )
+            # The cropper returns the same crop on every rerun; it is only
+            # mapped onto the working image the first time
+            try:
+                cropped_image, cropped_bytes, rect = cached_artifact(
+                    "crop",
+                    cropped_pic,
+                    lambda: apply_crop(cropped_pic),
+                    st.session_state.upload_key,
+                )
+            except CropNotFoundError as e:
+                # Better to ask again than to grade (and charge for) the wrong area
+                st.warning(f"{e} Please crop again, including more of the worksheet.")
+                return
+            except Exception as e:
+                st.error(f"Error processing cropped image: {str(e)}")
+                return
 
-            # Check if cropped_pic is bytes or a string
-            if isinstance(cropped_pic, str):
-                # Sometimes st_cropperjs returns a base64 string
-                import base64
-
-                try:
-                    # Try to decode if it's a base64 string
-                    if "base64," in cropped_pic:
-                        base64_data = cropped_pic.split("base64,")[1]
-                        with open(cropped_path, "wb") as f:
-                            f.write(base64.b64decode(base64_data))
-                    else:
-                        # If it's some other string format, try saving it directly
-                        with open(cropped_path, "wb") as f:
-                            f.write(cropped_pic.encode("utf-8"))
-                except Exception as e:
-                    st.error(f"Error processing cropped image: {str(e)}")
-                    return
-            else:
-                # If it's bytes, save directly
-                with open(cropped_path, "wb") as f:
-                    f.write(cropped_pic)
-
-            # Add to temp files list
-            st.session_state.temp_files.append(cropped_path)
-            st.session_state.cropped_image = cropped_path
+            st.session_state.cropped_image = cropped_image
+            st.session_state.cropped_image_bytes = cropped_bytes
+            st.session_state.crop_region = rect_corners(rect)
             st.session_state.cropping_complete = True
 
             # Show the cropped image and proceed button
             st.markdown("### Cropped Image")
-            st.image(cropped_path, width=400)
+            st.image(
+                cached_artifact(
+                    "crop_preview", cropped_pic, lambda: preview_bytes(cropped_image)
+                ),
+                width=PREVIEW_WIDTH,
+                output_format="JPEG",
+            )
 
             # Make buttons more mobile-friendly by adding space between them
             col1, col2 = st.columns(2)
@@ -135,65 +210,77 @@ def grader_page():
                 if st.button("Start Over", use_container_width=True):
                     reset_app()
 
+    # Step 3 for multi-page submissions: grade every page in turn
+    elif (
+        st.session_state.document_bytes is not None
+        and not st.session_state.grading_complete
+    ):
+        grade_document_step()
+
+    # Step 4 for multi-page submissions
+    elif st.session_state.document_bytes is not None:
+        show_document_results()
+
     # Step 3: Process the cropped image
     elif st.session_state.cropping_complete and not st.session_state.grading_complete:
-        # Process the image
-        with st.status("Grading homework...", expanded=True) as status:
-            st.write("Loading image...")
-            st.write("Adding grid overlay...")
-            st.write("Generating grading data...")
-            st.write("Applying grades to image...")
-
-            try:
-                graded_image_path, python_compatible_data = process_image(
-                    st.session_state.cropped_image
-                )
-                # Store results for display
-                st.session_state.graded_image_path = graded_image_path
-                st.session_state.python_compatible_data = python_compatible_data
-                st.session_state.grading_complete = True
-
-                # Complete
-                status.update(
-                    label="Grading complete!", state="complete", expanded=False
-                )
+        if st.session_state.grading_error is not None:
+            st.error(f"Error processing image: {st.session_state.grading_error}")
+            # Give option to try again
+            if st.button("Try Again"):
+                st.session_state.grading_error = None
+                st.session_state.cropping_complete = False
                 st.rerun()
-
-            except Exception as e:
-                st.error(f"Error processing image: {str(e)}")
-                status.update(label="Grading failed!", state="error", expanded=True)
-                # Give option to try again
-                if st.button("Try Again"):
-                    st.session_state.cropping_complete = False
-                    st.rerun()
+            return
+
+        # Grading runs on the worker pool; this page only polls for progress, so
+        # a rerun doesn't block on (or throw away) the model call
+        if st.session_state.grading_job is None:
+            # The page may already be graded (or grading) from upload time
+            st.session_state.grading_job = speculative_job_for(
+                st.session_state.crop_region
+            ) or grading_jobs.submit(
+                "process_image", grade_image_job, st.session_state.cropped_image
+            )
+            st.session_state.job_grader = ProgressiveGrader(
+                st.session_state.cropped_image
+            )
+        image_job_status()
 
     # Step 4: Display Results
     elif st.session_state.grading_complete:
+        stored = stored_result()
+        if stored is None:
+            return
+
         # Display results using mobile-friendly vertical layout
         st.markdown('<div class="results-container">', unsafe_allow_html=True)
 
         # Original image container
         st.markdown('<div class="image-container">', unsafe_allow_html=True)
         st.subheader("Original Homework")
-        original_img = Image.open(st.session_state.cropped_image)
-        st.image(original_img, use_container_width=True)
+        original_img = st.session_state.cropped_image
+        # Shown from the crop's encoded bytes, so reruns don't re-encode it
+        st.image(
+            st.session_state.cropped_image_bytes,
+            use_container_width=True,
+            output_format="JPEG",
+        )
         st.markdown("</div>", unsafe_allow_html=True)
 
         # Graded image container
         st.markdown('<div class="image-container">', unsafe_allow_html=True)
         st.subheader("Graded Homework")
-        processed_image = Image.open(st.session_state.graded_image_path)
-        st.image(processed_image, use_container_width=True)
+        # The graded image was encoded once when grading finished
+        st.image(stored.graded, use_container_width=True, output_format="JPEG")
 
         # Add a download button for the processed image
-        with open(st.session_state.graded_image_path, "rb") as file:
-            btn = st.download_button(
-                label="Download Graded Homework",
-                data=file,
-                file_name="graded_homework.png",
-                mime="image/png",
-                use_container_width=True,
-            )
+        btn = st.download_button(
+            label="Download Graded Homework",
+            data=stored.graded,
+            file_name="graded_homework.jpg",
+            mime=stored.mime_type,
+            use_container_width=True,
+        )
         st.markdown("</div>", unsafe_allow_html=True)
 
         st.markdown("</div>", unsafe_allow_html=True)
@@ -208,12 +295,14 @@ def grader_page():
 
         # Display the generated data
         with st.expander("Grading Data"):
-            st.code(st.session_state.python_compatible_data, language="python")
+            grading_result = stored.result
+            st.json(grading_result.to_dict())
 
-            # Add a download button for the data
+            # Add a download button for the data (the Python literal is only
+            # built here, once per result)
             st.download_button(
                 label="Download Data as Python File",
-                data=f"data = {st.session_state.python_compatible_data}",
+                data=f"data = {grading_result.python_literal}",
                 file_name="homework_grade_data.py",
                 mime="text/plain",
             )
@@ -223,6 +312,259 @@ def grader_page():
             reset_app()
 
 
+def cached_artifact(kind, content, build, *params):
+    """
+    Build a page artifact (a decoded or encoded image) once per content hash and
+    parameters; later reruns get the same object back without any image work.
+    """
+    key = make_cache_key(kind, content, *(str(param) for param in params))
+    return artifact_cache.get_or_set(key, build)
+
+
+def apply_crop(cropped_pic):
+    """
+    Apply the crop made on the proxy to the working image kept since the upload.
+
+    Returns:
+        tuple: (PIL image, JPEG bytes of it, crop rectangle in the working image)
+    """
+    # Check if cropped_pic is bytes or a string
+    if isinstance(cropped_pic, str):
+        # Sometimes st_cropperjs returns a base64 string
+        if "base64," in cropped_pic:
+            base64_data = cropped_pic.split("base64,")[1]
+            cropped_bytes = base64.b64decode(base64_data)
+        else:
+            # If it's some other string format, use it directly
+            cropped_bytes = cropped_pic.encode("utf-8")
+    else:
+        cropped_bytes = bytes(cropped_pic)
+    cropped_image, rect = crop_full_resolution(
+        st.session_state.original_image, st.session_state.crop_proxy, cropped_bytes
+    )
+    logger.info("Cropped %s to %s", st.session_state.original_image.size, rect)
+    cropped_bytes = image_to_bytes(cropped_image, format="JPEG", quality=CROP_QUALITY)
+    return cropped_image, cropped_bytes, rect
+
+
+def preview_bytes(image):
+    # Encoded at the size it is shown, so Streamlit passes the bytes through
+    # instead of resizing and re-encoding them
+    preview = image.convert("RGB")
+    if preview.width > PREVIEW_WIDTH:
+        preview = resize_image_width(preview, target_width=PREVIEW_WIDTH)
+    return image_to_bytes(preview, format="JPEG", quality=PREVIEW_QUALITY)
+
+
+def current_job():
+    """
+    Return this session's grading job, or None after resubmitting it if the
+    server no longer knows it (e.g. after a restart).
+    """
+    job = grading_jobs.get(st.session_state.grading_job)
+    if job is None:
+        # Grading it again is cheap: finished responses are cached
+        logger.warning(
+            "Grading job %s was lost, resubmitting", st.session_state.grading_job
+        )
+        st.session_state.grading_job = None
+        st.rerun()
+    return job
+
+
+def start_speculative_grading(page_image):
+    """
+    Start grading the detected page while the user is still cropping. Its quota
+    is charged to a ledger so it can be refunded if the result isn't used.
+    """
+    ledger = QuotaLedger()
+    st.session_state.speculative_ledger = ledger
+    st.session_state.speculative_job = grading_jobs.submit(
+        "speculative_grade", speculative_grade_job, page_image, ledger
+    )
+
+
+def discard_speculative_grading(reason):
+    """Cancel the speculative grading, drop its result and refund its quota."""
+    job_id = st.session_state.speculative_job
+    ledger = st.session_state.speculative_ledger
+    st.session_state.speculative_job = None
+    st.session_state.speculative_ledger = None
+    if job_id is None:
+        return
+    grading_jobs.cancel(job_id)
+    result_store.pop(job_id)
+    refunded = ledger.cancel()
+    logger.info(
+        "Discarded speculative grading %s (%s, %d slot(s) refunded)",
+        job_id[:8],
+        reason,
+        refunded,
+    )
+
+
+def speculative_job_for(crop_region):
+    """
+    Return the speculative grading job if the final crop closely matches the
+    page it is grading, and switch the session over to that page. Otherwise
+    discard it and return None.
+    """
+    job_id = st.session_state.speculative_job
+    if job_id is None:
+        return None
+    job = grading_jobs.get(job_id)
+    auto_crop = st.session_state.auto_crop
+    iou = 0.0
+    if crop_region is not None:
+        iou = region_iou(crop_region, auto_crop.corners)
+    if job is None or job.status == FAILED or iou < SPECULATIVE_MIN_IOU:
+        discard_speculative_grading(f"crop IoU {iou:.2f}")
+        return None
+
+    logger.info("Reusing speculative grading %s (crop IoU %.2f)", job_id[:8], iou)
+    # The marks are placed on the detected page, so it becomes the crop
+    st.session_state.cropped_image = auto_crop.image
+    st.session_state.cropped_image_bytes = image_to_bytes(
+        auto_crop.image, format="JPEG", quality=CROP_QUALITY
+    )
+    st.session_state.speculative_job = None
+    st.session_state.speculative_ledger = None
+    return job_id
+
+
+def finish_job(job):
+    """Pick up a finished job's result (or error) and rerun the whole page."""
+    grading_jobs.pop(job.id)
+    st.session_state.grading_job = None
+    if job.status == FAILED:
+        st.session_state.grading_error = str(job.error)
+        st.rerun()
+    return job.result
+
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def image_job_status():
+    job = current_job()
+    with st.status("Grading homework...", expanded=True) as status:
+        st.write("Loading image...")
+        st.write("Adding grid overlay...")
+        st.write("Generating grading data...")
+        st.write("Applying grades to image...")
+
+        # Marks are drawn and shown as each question arrives from the stream
+        grader = st.session_state.job_grader
+        for question in job.events_since(len(grader.questions)):
+            grader.add(question)
+        st.write(
+            f"Graded {len(grader.questions)} questions so far "
+            f"({grader.correct_count} correct)..."
+        )
+        # Encoded once per new question, not on every poll
+        st.image(
+            cached_artifact(
+                "preview",
+                job.id,
+                lambda: preview_bytes(grader.image),
+                len(grader.questions),
+            ),
+            width=PREVIEW_WIDTH,
+            output_format="JPEG",
+        )
+
+        if job.done:
+            # The result itself is in the result store under the job ID
+            st.session_state.mongo_timing = finish_job(job)
+            st.session_state.result_key = job.id
+            st.session_state.job_grader = None
+            st.session_state.grading_complete = True
+
+            # Complete
+            status.update(label="Grading complete!", state="complete", expanded=False)
+            st.rerun()
+
+
+def grade_document_step():
+    if st.session_state.grading_error is not None:
+        st.error(f"Error processing document: {st.session_state.grading_error}")
+        if st.button("Start Over"):
+            reset_app()
+        return
+
+    if st.session_state.grading_job is None:
+        st.session_state.grading_job = grading_jobs.submit(
+            "grade_document", grade_document_job, st.session_state.document_bytes
+        )
+    document_job_status()
+
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def document_job_status():
+    job = current_job()
+    with st.status("Grading pages...", expanded=True) as status:
+        events = job.events_since(0)
+        if events:
+            number, page_count, correct, total, preview = events[-1]
+            st.progress(number / page_count)
+            st.write(
+                f"Graded page {number} of {page_count} ({correct}/{total} correct)"
+            )
+            st.image(preview, width=PREVIEW_WIDTH, output_format="JPEG")
+        else:
+            st.progress(0.0)
+
+        if job.done:
+            finish_job(job)
+            st.session_state.result_key = job.id
+            st.session_state.grading_complete = True
+            status.update(label="Grading complete!", state="complete", expanded=False)
+            st.rerun()
+
+
+def stored_result():
+    """
+    Return this session's result from the result store, or None (with a way to
+    start over) once it has been evicted or has expired.
+    """
+    stored = result_store.get(st.session_state.result_key)
+    if stored is None:
+        st.warning("These results have expired. Please grade the homework again.")
+        if st.button("Grade Another Image", use_container_width=True):
+            reset_app()
+    return stored
+
+
+def show_document_results():
+    stored = stored_result()
+    if stored is None:
+        return
+
+    document_result = stored.result
+    st.subheader(
+        f"Score: {document_result.correct_answers}/"
+        f"{document_result.total_amount_of_questions} "
+        f"over {len(document_result.pages)} pages"
+    )
+    st.download_button(
+        label="Download Graded Pages (PDF)",
+        data=stored.graded,
+        file_name="graded_homework.pdf",
+        mime=stored.mime_type,
+        use_container_width=True,
+    )
+
+    with st.expander("Grading Data"):
+        st.json(document_result.to_dict())
+        st.download_button(
+            label="Download Data as Python File",
+            data=f"data = {document_result.python_literal}",
+            file_name="homework_grade_data.py",
+            mime="text/plain",
+        )
+
+    if st.button("Grade Another Submission", use_container_width=True):
+        reset_app()
+
+
 def about_page():
     # About page content
     st.title("About the Homework Grader")
@@ -296,135 +638,151 @@ def about_page():
         "Images are processed temporarily and not stored permanently after grading."
     )
     st.write(
-        "All temporary files are deleted when you reset the app or close the browser."
+        "Graded images are kept in server memory only, and are dropped when you "
+        "reset the app or an hour after you last viewed them."
+    )
+    st.write(
+        "The grading data for each sheet (the questions, the student's answers and "
+        "whether they are correct, but not the image) is cached on the server's "
+        "disk until a week after it was last used, so grading the same sheet "
+        "again doesn't call the AI model again."
     )
 
 
-# Create a session state for tracking temporary files
-if "temp_files" not in st.session_state:
-    st.session_state.temp_files = []
-
-# Initialize other session state variables
+# Initialize session state variables
 if "cropped_image" not in st.session_state:
     st.session_state.cropped_image = None
+if "cropped_image_bytes" not in st.session_state:
+    st.session_state.cropped_image_bytes = None
 if "upload_complete" not in st.session_state:
     st.session_state.upload_complete = False
 if "cropping_complete" not in st.session_state:
     st.session_state.cropping_complete = False
 if "grading_complete" not in st.session_state:
     st.session_state.grading_complete = False
-if "original_image_path" not in st.session_state:
-    st.session_state.original_image_path = None
-if "graded_image_path" not in st.session_state:
-    st.session_state.graded_image_path = None
-if "python_compatible_data" not in st.session_state:
-    st.session_state.python_compatible_data = None
+if "original_image" not in st.session_state:
+    st.session_state.original_image = None
+if "crop_proxy" not in st.session_state:
+    st.session_state.crop_proxy = None
+if "upload_key" not in st.session_state:
+    st.session_state.upload_key = None
+if "auto_crop" not in st.session_state:
+    st.session_state.auto_crop = None
+if "crop_region" not in st.session_state:
+    st.session_state.crop_region = None
+if "speculative_job" not in st.session_state:
+    st.session_state.speculative_job = None
+if "speculative_ledger" not in st.session_state:
+    st.session_state.speculative_ledger = None
+if "result_key" not in st.session_state:
+    st.session_state.result_key = None
+if "mongo_timing" not in st.session_state:
+    st.session_state.mongo_timing = None
+if "document_bytes" not in st.session_state:
+    st.session_state.document_bytes = None
+if "grading_job" not in st.session_state:
+    st.session_state.grading_job = None
+if "job_grader" not in st.session_state:
+    st.session_state.job_grader = None
+if "grading_error" not in st.session_state:
+    st.session_state.grading_error = None
 
 GEMINI_API_KEY = st.secrets["GEMINI_API_KEY"]
-
-
-def clean_temp_files():
-    """
-    Clean up all temporary files stored in the session state
-    """
-    for file_path in st.session_state.temp_files:
+# Grade the detected page at upload time, while the user crops
+SPECULATIVE_GRADING = st.secrets.get("SPECULATIVE_GRADING", False)
+
+
+def process_image(input_image, on_question=None):
+    # The whole request runs on in-memory images; nothing below writes an image
+    # to disk. Every stage is recorded as a span in the request trace shown in
+    # the sidebar's performance panel. Runs on the grading worker pool, so it
+    # must not touch st.session_state.
+    with start_trace(
+        "process_image", width=input_image.width, height=input_image.height
+    ) as trace:
+        # Steps 1 and 2: Resize for the model, overlay the grid, encode the
+        # payload and generate grading data (parsed and validated straight from
+        # the stream). Tall sheets are graded as overlapping bands in parallel.
+        reset_mongo_timing()
         try:
-            if os.path.exists(file_path):
-                os.unlink(file_path)
-        except Exception as e:
-            st.warning(f"Could not delete temp file {file_path}: {e}")
-
-    # Clear the list after attempting to remove all files
-    st.session_state.temp_files = []
-
-
-def process_image(input_image_path):
-    # Step 1: Overlay grid on the image
-    grid_output_path = os.path.join(
-        tempfile.gettempdir(),
-        f"output_image_with_grid_{os.path.basename(input_image_path)}",
-    )
-    overlay_grid_on_image(
-        input_image_path,
-        grid_spacing=50,
-        grid_opacity=50,
-        label_inset=10,
-        label_font_size=14,
-        output_path=grid_output_path,
-    )
-
-    # Add grid path to temp files for cleanup
-    st.session_state.temp_files.append(grid_output_path)
-
-    counter_data = read_counter()
-    print(counter_data)
-    if not counter_data["can_make_request"]:
-        # Ratge Limit Hit
-        if counter_data["daily_remaining"] <= 0:
-            raise Exception(
-                "Global Daily rate limit reached. Please contact developer at jorgezavala.um@gmail.com if you would like to try this app."
-            )
-        else:
-            raise Exception(
-                "Global Monthly rate limit reached. Please contact developer at jorgezavala.um@gmail.com if you would like to try this app."
+            grading_result = run_sheet(
+                input_image, api_key=GEMINI_API_KEY, on_question=on_question
             )
+        finally:
+            mongo_timing = get_mongo_timing()
+            trace.set("mongo_ms", round(mongo_timing["seconds"] * 1000, 1))
+            logger.info("MongoDB time for this request: %s", mongo_timing)
 
-    # Step 2: Generate grading data
-    input_prompt = "grade this. include unanswered problems. **The 'correctness' property you return should be true if the student answer is correct for that question and false if incorrect**. *Notice that there is a graph overlay. Use that to help you approximate coordinates of answers*"
-    python_compatible_data = generate(
-        image_path=grid_output_path,
-        prompt_text=input_prompt,
-        api_key=GEMINI_API_KEY,
-    )
-
-    # Update counter by 1
-    update_counter()
+        # Step 3: Apply grading to the image
+        result = grade(input_image, data=grading_result)
+        trace.set("questions", grading_result.total_amount_of_questions)
 
-    # Write the data to a temporary file
-    data_file_path = os.path.join(
-        tempfile.gettempdir(),
-        f"python_compatible_data_{os.path.basename(input_image_path)}.py",
-    )
-    with open(data_file_path, "w") as f:
-        f.write("data = " + python_compatible_data)
-
-    # Add data path to temp files for cleanup
-    st.session_state.temp_files.append(data_file_path)
-
-    # Import the data from the temporary file
-    import sys
+    return result["image"], grading_result, mongo_timing
 
-    sys.path.append(tempfile.gettempdir())
-    import importlib.util
-
-    spec = importlib.util.spec_from_file_location(
-        "python_compatible_data", data_file_path
-    )
-    module = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(module)
 
-    # Step 3: Apply grading to the image
-    output_image_path = os.path.join(
-        tempfile.gettempdir(), f"graded_homework_{os.path.basename(input_image_path)}"
+def grade_image_job(job, input_image):
+    # Worker pool entry point: streamed questions are published on the job for
+    # the page to draw while it polls. The graded image is encoded once and
+    # kept in the result store under the job ID.
+    graded_image, grading_result, mongo_timing = process_image(
+        input_image, on_question=job.publish
     )
-    grade(input_image_path, data=module.data, output_path=output_image_path)
-
-    # Add output path to temp files for cleanup
-    st.session_state.temp_files.append(output_image_path)
+    if not job.cancelled:
+        # JPEG like the crop it was graded from: a lossless PNG of a photo
+        # is over 10x slower to encode and several times larger
+        graded_bytes = image_to_bytes(graded_image, format="JPEG", quality=CROP_QUALITY)
+        result_store.put(job.id, graded_bytes, "image/jpeg", grading_result)
+    return mongo_timing
+
+
+def speculative_grade_job(job, input_image, ledger):
+    # Model calls are charged to the ledger, which is refunded if the grading
+    # is discarded; a reused one stays charged once like any other grading
+    with charge_to(ledger):
+        return grade_image_job(job, input_image)
+
+
+def grade_document_job(job, document_bytes):
+    def publish_page(number, page_count, graded_image, result):
+        # Only progress and a small preview are kept on the job, so finished
+        # pages aren't held as bitmaps until the job is picked up
+        job.publish(
+            (
+                number,
+                page_count,
+                result.correct_answers,
+                result.total_amount_of_questions,
+                preview_bytes(graded_image),
+            )
+        )
 
-    return output_image_path, python_compatible_data
+    with start_trace("grade_document"):
+        document_result, graded_pdf = grade_document(
+            document_bytes, api_key=GEMINI_API_KEY, on_page=publish_page
+        )
+    result_store.put(job.id, graded_pdf, "application/pdf", document_result)
 
 
 def reset_app():
     """Reset the app to initial state"""
-    clean_temp_files()
+    result_store.pop(st.session_state.result_key)
+    discard_speculative_grading("reset")
     st.session_state.cropped_image = None
+    st.session_state.cropped_image_bytes = None
     st.session_state.upload_complete = False
     st.session_state.cropping_complete = False
     st.session_state.grading_complete = False
-    st.session_state.original_image_path = None
-    st.session_state.graded_image_path = None
-    st.session_state.python_compatible_data = None
+    st.session_state.original_image = None
+    st.session_state.crop_proxy = None
+    st.session_state.upload_key = None
+    st.session_state.auto_crop = None
+    st.session_state.crop_region = None
+    st.session_state.result_key = None
+    st.session_state.document_bytes = None
+    # A running job is left to finish (its response is cached) but forgotten
+    st.session_state.grading_job = None
+    st.session_state.job_grader = None
+    st.session_state.grading_error = None
     # Force a refresh
     st.rerun()
 
@@ -449,23 +807,106 @@ def main():
         if st.button(
             "🔄 Reset App",
             use_container_width=True,
-            help="Clears all temporary files and resets the app",
+            help="Clears your results and resets the app",
         ):
             reset_app()
-            st.success("All temporary files have been cleared and app has been reset!")
+            st.success("Your results have been cleared and the app has been reset!")
 
         # Debug info in sidebar (always visible)
-        with st.expander("Debug: Temporary Files"):
-            st.write(f"Number of temp files: {len(st.session_state.temp_files)}")
-            for file in st.session_state.temp_files:
-                st.write(f"- {file} (Exists: {os.path.exists(file)})")
+        with st.expander("Debug: Result Store"):
+            store_stats = result_store.stats()
+            st.write(
+                f"{store_stats['entries']} results, "
+                f"{store_stats['bytes'] / 1024 / 1024:.1f} / "
+                f"{store_stats['max_bytes'] / 1024 / 1024:.0f} MB"
+            )
+            st.write(
+                f"Hits: {store_stats['hits']}, misses: {store_stats['misses']}, "
+                f"evictions: {store_stats['evictions']}"
+            )
 
-    # Run the selected page
-    page.run()
+        with st.expander("Debug: Response Cache"):
+            cache_stats = response_cache.stats()
+            st.write(
+                f"Hits: {cache_stats['hits']} / {cache_stats['lookups']} lookups "
+                f"({cache_stats['hit_rate']:.0%})"
+            )
+            st.write(
+                f"Memory: {cache_stats['memory']['entries']} entries, "
+                f"{cache_stats['memory']['bytes'] / 1024:.1f} KB"
+            )
+            st.write(
+                f"Disk: {cache_stats['disk']['entries']} entries, "
+                f"{cache_stats['disk']['bytes'] / 1024:.1f} KB"
+            )
+            flight_stats = model_flights.stats()
+            st.write(
+                f"In flight: {flight_stats['in_flight']} model calls, "
+                f"{flight_stats['waiting']} waiting; "
+                f"{flight_stats['coalesced']} calls saved by coalescing"
+            )
+            job_stats = grading_jobs.stats()
+            st.write(
+                f"Grading jobs: {job_stats['running']} running, "
+                f"{job_stats['queued']} queued"
+            )
 
+        with st.expander("Debug: MongoDB"):
+            if st.session_state.mongo_timing is not None:
+                st.write(
+                    f"Last request: {st.session_state.mongo_timing['seconds'] * 1000:.0f} ms "
+                    f"in {st.session_state.mongo_timing['calls']} counter operations"
+                )
+            if st.button("Check connection", use_container_width=True):
+                health = check_health()
+                if health["ok"]:
+                    st.success(f"Connected ({health['latency_ms']:.0f} ms ping)")
+                else:
+                    st.error(f"Connection failed: {health['error']}")
+
+        with st.expander("Debug: Performance"):
+            reruns = rerun_stats()
+            if reruns is not None:
+                st.write(
+                    f"Script reruns: last {reruns['last_ms']:.1f} ms, median "
+                    f"{reruns['median_ms']:.1f} ms, max {reruns['max_ms']:.1f} ms "
+                    f"(last {reruns['count']})"
+                )
+            traces = recent_traces(
+                st.number_input(
+                    "Requests to show",
+                    min_value=1,
+                    max_value=TRACE_HISTORY,
+                    value=5,
+                    key="trace_count",
+                )
+            )
+            if not traces:
+                st.write("No graded requests yet.")
+            for trace in traces:
+                status = "failed" if trace.error else "ok"
+                st.markdown(
+                    f"**{trace.started_at:%H:%M:%S}** {trace.name}: "
+                    f"{trace.duration_ms:.0f} ms ({status})"
+                )
+                st.caption(
+                    ", ".join(
+                        f"{key}={value}" for key, value in trace.attributes.items()
+                    )
+                )
+                if trace.error:
+                    st.caption(trace.error)
+                st.dataframe(trace.to_rows(), hide_index=True, use_container_width=True)
+
+    # Run the selected page
+    try:
+        page.run()
+    finally:
+        # Also recorded when the page ends early with st.rerun()
+        rerun_ms = (time.perf_counter() - RERUN_START) * 1000
+        record_rerun(rerun_ms)
+        logger.debug("Script rerun took %.1f ms", rerun_ms)
 
-# Register cleanup function to run on exit
-atexit.register(clean_temp_files)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,251 @@
+"""
+Headless batch grading.
+
+Grades every image in one or more directories or glob patterns with the same
+pipeline as the Streamlit app and writes the graded images plus a run summary.
+Multi-page PDFs and TIFFs are graded page by page into a graded PDF.
+
+Usage:
+    python batch.py worksheets/ --output-dir graded --workers 4
+    python batch.py "scans/class_3b_*.jpg" --output-dir graded
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+from counter import get_mongo_timing, reset_mongo_timing
+from grade import grade
+from ingest import count_pages, decode_upload, grade_document, is_pdf
+from pipeline import QuotaExceededError, limit_model_calls
+from tiling import run_sheet
+from tracing import start_trace
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".pdf", ".tif", ".tiff")
+DEFAULT_WORKERS = 4
+
+
+def collect_images(inputs):
+    """Expand directories and glob patterns into a sorted list of image paths."""
+    paths = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            candidates = [os.path.join(item, name) for name in os.listdir(item)]
+        else:
+            candidates = glob.glob(item)
+        for path in candidates:
+            if os.path.isfile(path) and path.lower().endswith(IMAGE_EXTENSIONS):
+                paths.add(path)
+    return sorted(paths)
+
+
+def get_api_key(cli_key=None):
+    """Use the --api-key flag, then $GEMINI_API_KEY, then Streamlit secrets."""
+    if cli_key:
+        return cli_key
+    if os.environ.get("GEMINI_API_KEY"):
+        return os.environ["GEMINI_API_KEY"]
+    import streamlit as st
+
+    return st.secrets["GEMINI_API_KEY"]
+
+
+def output_names(image_paths):
+    """Map each input to a unique output stem, even if basenames repeat."""
+    names = {}
+    seen = {}
+    for path in image_paths:
+        stem = os.path.splitext(os.path.basename(path))[0]
+        seen[stem] = seen.get(stem, 0) + 1
+        names[path] = stem if seen[stem] == 1 else f"{stem}_{seen[stem]}"
+    return names
+
+
+def grade_one(image_path, name, output_dir, api_key, stop_event):
+    """
+    Run the full pipeline for one image (or every page of a document).
+
+    Returns:
+        dict: Summary entry for this image
+    """
+    entry = {"input": image_path, "status": "skipped"}
+
+    # Don't start new model calls once the quota is gone
+    if stop_event.is_set():
+        entry["error"] = "Quota exhausted before this image was graded"
+        return entry
+
+    start = time.perf_counter()
+    reset_mongo_timing()
+    try:
+        with start_trace("batch", input=image_path) as trace:
+            try:
+                if is_pdf(image_path) or count_pages(image_path) > 1:
+                    entry.update(_grade_document(image_path, name, output_dir, api_key))
+                else:
+                    entry.update(_grade_image(image_path, name, output_dir, api_key))
+            finally:
+                # Payload choices, upload size and model latency, for tuning the
+                # payload settings
+                entry.update(
+                    {k: v for k, v in trace.attributes.items() if k != "input"}
+                )
+    except QuotaExceededError as e:
+        stop_event.set()
+        entry["error"] = str(e)
+    except Exception as e:
+        entry.update({"status": "failed", "error": str(e)})
+
+    entry["seconds"] = round(time.perf_counter() - start, 2)
+    entry["mongo_seconds"] = round(get_mongo_timing()["seconds"], 3)
+    return entry
+
+
+def _grade_image(image_path, name, output_dir, api_key):
+    # Decode at the working width and fix orientation, the same way the upload
+    # step does
+    image = decode_upload(image_path, target_width=1024).image
+
+    data = run_sheet(image, api_key=api_key)
+
+    output_path = os.path.join(output_dir, f"graded_{name}.png")
+    result = grade(image, data=data, output_path=output_path)
+
+    correct_count = sum(1 for q in data.questions if q.correctness)
+    return {
+        "status": "graded",
+        "output": output_path,
+        "correct": correct_count,
+        "total": data.total_amount_of_questions,
+        "marked_answers": result["marked_answers"],
+    }
+
+
+def _grade_document(image_path, name, output_dir, api_key):
+    # Multi-page PDF or TIFF: one graded PDF and one combined score
+    data, graded_pdf = grade_document(image_path, api_key=api_key)
+
+    output_path = os.path.join(output_dir, f"graded_{name}.pdf")
+    with open(output_path, "wb") as f:
+        f.write(graded_pdf)
+
+    return {
+        "status": "graded",
+        "output": output_path,
+        "pages": len(data.pages),
+        "correct": data.correct_answers,
+        "total": data.total_amount_of_questions,
+    }
+
+
+def run_batch(image_paths, output_dir, api_key, workers=DEFAULT_WORKERS):
+    """
+    Grade all images with at most `workers` concurrent model calls, counting
+    the bands of tall sheets (which are graded in parallel within a sheet).
+
+    Returns:
+        dict: Per-run summary (also written to summary.json in output_dir)
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    stop_event = threading.Event()
+    started_at = datetime.now()
+    start = time.perf_counter()
+    entries = []
+    names = output_names(image_paths)
+    model_calls = threading.BoundedSemaphore(workers)
+
+    def grade_limited(path):
+        with limit_model_calls(model_calls):
+            return grade_one(path, names[path], output_dir, api_key, stop_event)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(grade_limited, path) for path in image_paths]
+        for future in as_completed(futures):
+            entry = future.result()
+            entries.append(entry)
+            print(
+                f"[{len(entries)}/{len(futures)}] {entry['status']}: "
+                f"{entry['input']}"
+            )
+
+    entries.sort(key=lambda e: e["input"])
+    summary = {
+        "started_at": started_at.isoformat(timespec="seconds"),
+        "seconds": round(time.perf_counter() - start, 2),
+        "workers": workers,
+        "images": len(entries),
+        "graded": sum(1 for e in entries if e["status"] == "graded"),
+        "failed": sum(1 for e in entries if e["status"] == "failed"),
+        "skipped": sum(1 for e in entries if e["status"] == "skipped"),
+        "quota_exhausted": stop_event.is_set(),
+        "results": entries,
+    }
+
+    summary_path = os.path.join(output_dir, "summary.json")
+    with open(summary_path, "w") as f:
+        json.dump(summary, f, indent=2)
+    print(f"Summary written to {summary_path}")
+
+    return summary
+
+
+def print_summary(summary):
+    for entry in summary["results"]:
+        if entry["status"] == "graded":
+            detail = f"{entry['correct']}/{entry['total']}"
+        else:
+            detail = entry.get("error", "")
+        print(f"{entry['status']:>8}  {os.path.basename(entry['input'])}  {detail}")
+    print(
+        f"\nGraded {summary['graded']} of {summary['images']} images in "
+        f"{summary['seconds']}s ({summary['failed']} failed, "
+        f"{summary['skipped']} skipped)"
+    )
+    if summary["quota_exhausted"]:
+        print("Stopped early: the Gemini quota is exhausted.")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Grade a batch of homework images.")
+    parser.add_argument(
+        "inputs", nargs="+", help="Image files, directories or glob patterns"
+    )
+    parser.add_argument(
+        "-o", "--output-dir", default="graded", help="Where to write graded images"
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Maximum number of concurrent Gemini calls",
+    )
+    parser.add_argument("--api-key", help="Gemini API key (default: $GEMINI_API_KEY)")
+    args = parser.parse_args(argv)
+
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    image_paths = collect_images(args.inputs)
+    if not image_paths:
+        print("No images found.")
+        return 1
+
+    summary = run_batch(
+        image_paths,
+        args.output_dir,
+        api_key=get_api_key(args.api_key),
+        workers=args.workers,
+    )
+    print_summary(summary)
+    return 0 if summary["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,82 @@
+"""
+Compare the grid overlay methods in graph.py.
+
+Run from the repository root:
+    python -m benchmarks.bench_grid
+"""
+
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+import fonts
+import graph
+from pipeline import GRID_SETTINGS
+
+# Typical sheets after resize_image_width(1024): letter page, long sheet, very tall
+SIZES = [(1024, 1325), (1024, 2600), (1024, 5200)]
+METHODS = ["draw", "layer", "numpy"]
+REPEATS = 10
+
+
+def make_sheet(width, height):
+    """A white page with some dark handwriting-like strokes."""
+    img = Image.new("RGB", (width, height), (250, 250, 245))
+    draw = ImageDraw.Draw(img)
+    for y in range(60, height - 40, 80):
+        draw.text((80, y), f"{y // 80}) 14 x 83 = 1162", fill=(20, 20, 20))
+        draw.line([(300, y + 10), (500, y + 14)], fill=(30, 30, 120), width=3)
+    return img
+
+
+def clear_caches():
+    graph._grid_tile_strip.cache_clear()
+    graph._label_strips.cache_clear()
+    fonts.render_text.cache_clear()
+
+
+def time_method(img, method):
+    """Returns (cold_ms, warm_ms) where cold includes building the cached strips."""
+    clear_caches()
+    start = time.perf_counter()
+    graph.overlay_grid_on_image(img, method=method, **GRID_SETTINGS)
+    cold = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        graph.overlay_grid_on_image(img, method=method, **GRID_SETTINGS)
+    warm = (time.perf_counter() - start) * 1000 / REPEATS
+    return cold, warm
+
+
+def max_difference(img, method):
+    reference = np.asarray(
+        graph.overlay_grid_on_image(img, method="draw", **GRID_SETTINGS), dtype=int
+    )
+    result = np.asarray(
+        graph.overlay_grid_on_image(img, method=method, **GRID_SETTINGS), dtype=int
+    )
+    return int(np.abs(reference - result).max())
+
+
+def main():
+    print(
+        f"{'size':>12} {'method':>7} {'cold ms':>9} {'warm ms':>9} {'speedup':>8} "
+        f"{'max diff':>9}"
+    )
+    for width, height in SIZES:
+        img = make_sheet(width, height)
+        baseline = None
+        for method in METHODS:
+            cold, warm = time_method(img, method)
+            if baseline is None:
+                baseline = warm
+            print(
+                f"{width}x{height:<7} {method:>7} {cold:9.1f} {warm:9.1f} "
+                f"{baseline / warm:7.1f}x {max_difference(img, method):9d}"
+            )
+
+
+if __name__ == "__main__":
+    main()
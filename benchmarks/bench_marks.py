@@ -0,0 +1,91 @@
+"""
+Compare the mark rendering methods in grade.py.
+
+Run from the repository root:
+    python -m benchmarks.bench_marks
+"""
+
+import random
+import time
+
+import numpy as np
+from PIL import Image
+
+import grade
+
+# Sheet sizes after resize_image_width(1024) and marks per sheet
+SIZES = [(1024, 1325), (1024, 5200)]
+MARK_COUNTS = [10, 100, 500]
+METHODS = ["draw", "sprite"]
+REPEATS = 10
+
+
+def make_marks(width, height, count, seed=0):
+    """Random check and X marks spread over the sheet."""
+    rng = random.Random(seed)
+    marks = []
+    for _ in range(count):
+        correct = rng.random() < 0.7
+        marks.append(
+            {
+                "coords": (rng.randrange(40, width), rng.randrange(0, height)),
+                "type": "check" if correct else "x_mark",
+                "color": "green" if correct else "red",
+                "is_correct": correct,
+            }
+        )
+    return marks
+
+
+def render(img, marks, method):
+    grade.render_marks(img, marks, method)
+    return img
+
+
+def time_method(sheet, marks, method):
+    """Returns (cold_ms, warm_ms) where cold includes rendering the sprites."""
+    grade.render_mark.cache_clear()
+    img = sheet.copy()
+    start = time.perf_counter()
+    render(img, marks, method)
+    cold = (time.perf_counter() - start) * 1000
+
+    total = 0.0
+    for _ in range(REPEATS):
+        img = sheet.copy()
+        start = time.perf_counter()
+        render(img, marks, method)
+        total += time.perf_counter() - start
+    return cold, total * 1000 / REPEATS
+
+
+def mean_difference(sheet, marks, method):
+    # Sprites are anti-aliased, so they differ from the drawn lines at the edges
+    reference = np.asarray(render(sheet.copy(), marks, "draw"), dtype=int)
+    result = np.asarray(render(sheet.copy(), marks, method), dtype=int)
+    return float(np.abs(reference - result).mean())
+
+
+def main():
+    print(
+        f"{'size':>12} {'marks':>6} {'method':>8} {'cold ms':>9} {'warm ms':>9} "
+        f"{'speedup':>8} {'mean diff':>10}"
+    )
+    for width, height in SIZES:
+        sheet = Image.new("RGB", (width, height), (250, 250, 245))
+        for count in MARK_COUNTS:
+            marks = make_marks(width, height, count)
+            baseline = None
+            for method in METHODS:
+                cold, warm = time_method(sheet, marks, method)
+                if baseline is None:
+                    baseline = warm
+                print(
+                    f"{width}x{height:<7} {count:6d} {method:>8} {cold:9.2f} "
+                    f"{warm:9.2f} {baseline / warm:7.1f}x "
+                    f"{mean_difference(sheet, marks, method):10.3f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
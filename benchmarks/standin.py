@@ -0,0 +1,453 @@
+"""
+Local stand-in for the Gemini streaming endpoint, for offline load tests.
+
+Serves `POST /<version>/models/<model>:streamGenerateContent?alt=sse` the way
+the real API does (server-sent events over a chunked HTTP/1.1 response), so the
+unmodified genai client in geminigen can be pointed at it with GEMINI_BASE_URL.
+
+Responses are looked up by the SHA-256 of the image sent in the request:
+  - replay: a recorded cassette is streamed back chunk for chunk; images
+    without a cassette get a synthetic schema-valid response sized to the image
+    (or a 404 with --strict)
+  - record: requests are forwarded to the real API, streamed through to the
+    caller and saved as cassettes together with the observed chunk timing
+
+Latency and failures can be injected on top of either mode.
+
+Run from the repository root:
+    python -m benchmarks.standin --ttft 1.5 --chunk-delay 0.05 --error-rate 0.1
+    GEMINI_BASE_URL=http://127.0.0.1:8765 streamlit run app.py
+
+    python -m benchmarks.standin --record   # capture real responses first
+"""
+
+import argparse
+import base64
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+from benchmarks.suite import canned_response
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_CHUNK_SIZE = 96  # Characters per synthetic chunk
+CASSETTE_DIR = os.path.join(os.path.dirname(__file__), "cassettes")
+UPSTREAM_URL = "https://generativelanguage.googleapis.com"
+
+STREAM_PATH = re.compile(
+    r"^/(?P<version>[^/]+)/models/(?P<model>[^:/]+):streamGenerate"
+)
+
+
+def _inline_image(request_body):
+    # The genai client sends URL-safe base64, sometimes without padding
+    for content in request_body.get("contents", []):
+        for part in content.get("parts", []):
+            inline_data = part.get("inlineData") or part.get("inline_data")
+            if inline_data and inline_data.get("data"):
+                data = inline_data["data"]
+                return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+    return None
+
+
+def image_key(request_body):
+    """
+    SHA-256 of the first inline image in a generateContent request body, or of
+    the whole body if it carries no image.
+    """
+    image_data = _inline_image(request_body)
+    if image_data is not None:
+        return hashlib.sha256(image_data).hexdigest()
+    return hashlib.sha256(json.dumps(request_body, sort_keys=True).encode()).hexdigest()
+
+
+def image_size(request_body):
+    """(width, height) of the request image, or a portrait sheet size if none."""
+    image_data = _inline_image(request_body)
+    if image_data is None:
+        return 1024, 1325
+    with Image.open(io.BytesIO(image_data)) as img:
+        return img.size
+
+
+def text_event(text, finish=False):
+    """One streamed response event carrying `text`."""
+    candidate = {"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}
+    if finish:
+        candidate["finishReason"] = "STOP"
+    return {"candidates": [candidate], "modelVersion": "standin"}
+
+
+def synthetic_events(width, height, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Split a canned response for an image of this size into streamed events."""
+    text = canned_response(width, height)
+    pieces = [text[i : i + chunk_size] for i in range(0, len(text), chunk_size)]
+    return [
+        text_event(piece, finish=i == len(pieces) - 1) for i, piece in enumerate(pieces)
+    ]
+
+
+def error_body(code, status, message):
+    return {"error": {"code": code, "message": message, "status": status}}
+
+
+class CassetteStore:
+    """Recorded responses on disk, one JSON file per image hash."""
+
+    def __init__(self, directory=CASSETTE_DIR):
+        self.directory = directory
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def load(self, key):
+        """
+        Returns:
+            dict: The cassette, or None if this image has not been recorded
+        """
+        try:
+            with open(self.path(key)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, key, cassette):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{self.path(key)}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(cassette, f, indent=2)
+        os.replace(tmp_path, self.path(key))
+
+
+class FaultInjector:
+    """
+    Latency and error settings applied to every response.
+
+    A delay of None replays the timing stored in the cassette (when there is
+    one); a number overrides it.
+    """
+
+    def __init__(
+        self,
+        ttft=None,
+        chunk_delay=None,
+        jitter=0.0,
+        error_rate=0.0,
+        midstream_error_rate=0.0,
+        seed=None,
+    ):
+        self.ttft = ttft
+        self.chunk_delay = chunk_delay
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.midstream_error_rate = midstream_error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _roll(self):
+        with self._lock:
+            return self._random.random()
+
+    def delay(self, configured, recorded):
+        seconds = configured if configured is not None else (recorded or 0.0)
+        if self.jitter and seconds:
+            seconds *= 1 + self.jitter * (2 * self._roll() - 1)
+        return max(0.0, seconds)
+
+    def fail_request(self):
+        return self._roll() < self.error_rate
+
+    def cut_stream(self):
+        return self._roll() < self.midstream_error_rate
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Chunked responses, keep-alive like the real API
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_POST(self):
+        match = STREAM_PATH.match(self.path)
+        length = int(self.headers.get("Content-Length", 0))
+        raw_body = self.rfile.read(length)
+        if match is None:
+            self._send_json(
+                404, error_body(404, "NOT_FOUND", f"Unknown endpoint {self.path}")
+            )
+            return
+
+        body = json.loads(raw_body or b"{}")
+        key = image_key(body)
+        self.server.count("requests")
+
+        faults = self.server.faults
+        if faults.fail_request():
+            self.server.count("injected_errors")
+            self._send_json(
+                503,
+                error_body(503, "UNAVAILABLE", "The model is overloaded (injected)."),
+            )
+            return
+
+        if self.server.record:
+            self._record(match, raw_body, key)
+        else:
+            self._replay(body, key)
+
+    # --- Replay ---
+
+    def _replay(self, body, key):
+        cassette = self.server.cassettes.load(key)
+        if cassette is not None:
+            self.server.count("replayed")
+            events = cassette["events"]
+            recorded_ttft = cassette.get("ttft_seconds")
+            recorded_gaps = cassette.get("chunk_gaps_seconds", [])
+        elif self.server.strict:
+            self.server.count("missing")
+            self._send_json(
+                404, error_body(404, "NOT_FOUND", f"No cassette for image {key}")
+            )
+            return
+        else:
+            self.server.count("synthetic")
+            events = synthetic_events(*image_size(body), self.server.chunk_size)
+            recorded_ttft, recorded_gaps = None, []
+
+        faults = self.server.faults
+        time.sleep(faults.delay(faults.ttft, recorded_ttft))
+        self._start_stream()
+        cut_at = len(events) // 2 if faults.cut_stream() else None
+        for i, event in enumerate(events):
+            if i == cut_at:
+                # Drop the connection without the terminating chunk
+                self.server.count("injected_cuts")
+                self.close_connection = True
+                return
+            if i > 0:
+                recorded_gap = recorded_gaps[i - 1] if i - 1 < len(recorded_gaps) else 0
+                time.sleep(faults.delay(faults.chunk_delay, recorded_gap))
+            self._send_event(event)
+        self._end_stream()
+
+    # --- Record ---
+
+    def _record(self, match, raw_body, key):
+        upstream_request = urllib.request.Request(
+            f"{self.server.upstream}{self.path}",
+            data=raw_body,
+            method="POST",
+            headers={
+                "Content-Type": "application/json",
+                "x-goog-api-key": self.headers.get("x-goog-api-key", ""),
+            },
+        )
+        start = time.perf_counter()
+        try:
+            upstream = urllib.request.urlopen(upstream_request, timeout=600)
+        except urllib.error.HTTPError as e:
+            self._send_raw(e.code, e.read())
+            return
+
+        events = []
+        arrivals = []
+        self._start_stream()
+        with upstream:
+            for line in upstream:
+                line = line.decode("utf-8").strip()
+                if not line.startswith("data: "):
+                    continue
+                arrivals.append(time.perf_counter())
+                event = json.loads(line[len("data: ") :])
+                events.append(event)
+                self._send_event(event)
+        self._end_stream()
+
+        self.server.cassettes.save(
+            key,
+            {
+                "model": match.group("model"),
+                "recorded_at": datetime.now().isoformat(timespec="seconds"),
+                "ttft_seconds": round(arrivals[0] - start, 4) if arrivals else 0.0,
+                "chunk_gaps_seconds": [
+                    round(later - earlier, 4)
+                    for earlier, later in zip(arrivals, arrivals[1:])
+                ],
+                "events": events,
+            },
+        )
+        self.server.count("recorded")
+
+    # --- Wire format ---
+
+    def _send_json(self, status, payload):
+        self._send_raw(status, json.dumps(payload).encode())
+
+    def _send_raw(self, status, data):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _start_stream(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def _send_event(self, event):
+        data = f"data: {json.dumps(event)}\r\n\r\n".encode()
+        self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def _end_stream(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    The stand-in server. Use serve_forever() from the CLI, or start() to run it
+    on a background thread inside a test or load script.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        host=DEFAULT_HOST,
+        port=DEFAULT_PORT,
+        faults=None,
+        cassettes=None,
+        record=False,
+        upstream=UPSTREAM_URL,
+        strict=False,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+        verbose=False,
+    ):
+        super().__init__((host, port), StandInHandler)
+        self.faults = faults or FaultInjector()
+        self.cassettes = cassettes or CassetteStore()
+        self.record = record
+        self.upstream = upstream.rstrip("/")
+        self.strict = strict
+        self.chunk_size = chunk_size
+        self.verbose = verbose
+        self.counts = {}
+        self._counts_lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, name):
+        with self._counts_lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def start(self):
+        """Serve on a daemon thread and return the server."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline Gemini stand-in server.")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument(
+        "--record",
+        action="store_true",
+        help="Forward to the real API and save responses as cassettes",
+    )
+    parser.add_argument("--upstream", default=UPSTREAM_URL, help="Real API base URL")
+    parser.add_argument("--cassettes", default=CASSETTE_DIR, help="Cassette directory")
+    parser.add_argument(
+        "--strict",
+        action="store_true",
+        help="Return 404 for unrecorded images instead of a synthetic response",
+    )
+    parser.add_argument(
+        "--ttft",
+        type=float,
+        help="Seconds before the first chunk (default: recorded timing, else 0)",
+    )
+    parser.add_argument(
+        "--chunk-delay",
+        type=float,
+        help="Seconds between chunks (default: recorded timing, else 0)",
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.0, help="Random +/- fraction on every delay"
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of requests answered with 503 UNAVAILABLE",
+    )
+    parser.add_argument(
+        "--midstream-error-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of streams dropped halfway through",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help="Characters per chunk for synthetic responses",
+    )
+    parser.add_argument("--seed", type=int, help="Seed for the injected faults")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log requests")
+    args = parser.parse_args(argv)
+
+    server = StandInServer(
+        args.host,
+        args.port,
+        faults=FaultInjector(
+            ttft=args.ttft,
+            chunk_delay=args.chunk_delay,
+            jitter=args.jitter,
+            error_rate=args.error_rate,
+            midstream_error_rate=args.midstream_error_rate,
+            seed=args.seed,
+        ),
+        cassettes=CassetteStore(args.cassettes),
+        record=args.record,
+        upstream=args.upstream,
+        strict=args.strict,
+        chunk_size=args.chunk_size,
+        verbose=args.verbose,
+    )
+    mode = "Recording" if args.record else "Replaying"
+    print(f"{mode} on {server.base_url} (cassettes in {args.cassettes})")
+    print(f"Point the app at it with GEMINI_BASE_URL={server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Served: {server.counts}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
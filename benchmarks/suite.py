@@ -0,0 +1,429 @@
+"""
+Per-stage benchmark of the grading pipeline, fully offline.
+
+Each stage is timed separately over a corpus of sample sheets (synthetic phone
+photos from 3 to 12 MP plus a tall multi-problem sheet, or your own images with
+--corpus). The Gemini call is replaced by a stub client that streams a canned
+response. For every stage the suite reports the median time, the peak memory
+growth and the bytes written to disk, and compares the timings with a stored
+baseline.
+
+Run from the repository root:
+    python -m benchmarks.suite                  # compare with the baseline
+    python -m benchmarks.suite --save-baseline  # record a new baseline
+    python -m benchmarks.suite --corpus scans/  # use real sheets
+"""
+
+import argparse
+import builtins
+import io
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from PIL import Image, ImageDraw
+
+import geminigen
+from crop import detect_page
+from grade import generate_marks_data, grade
+from graph import overlay_grid_on_image
+from ingest import decode_upload
+from payload import build_payload
+from pipeline import GRID_SETTINGS, INPUT_PROMPT
+from utils import fix_image_orientation, load_image, resize_image_width
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+DEFAULT_REPEATS = 5
+DEFAULT_TOLERANCE = 0.25  # Flag stages more than 25% slower than the baseline
+MIN_REGRESSION_MS = 1.0  # ...and at least this much slower, to ignore timer noise
+STUB_API_KEY = "offline-benchmark"
+STUB_CHUNK_SIZE = 64  # Characters per streamed chunk
+
+# (name, width, height, EXIF orientation) for the synthetic corpus
+SYNTHETIC_SHEETS = [
+    ("phone_3mp", 2048, 1536, 6),
+    ("phone_6mp", 3008, 2000, 6),
+    ("phone_12mp", 4032, 3024, 6),
+    ("tall_sheet", 1700, 6800, 1),
+]
+
+
+# --- Corpus ---
+
+
+def make_sheet(width, height, orientation):
+    """
+    A JPEG of a worksheet with numbered problems, stored sideways with an EXIF
+    orientation tag like a phone photo.
+    """
+    img = Image.new("RGB", (width, height), (245, 243, 235))
+    draw = ImageDraw.Draw(img)
+    line_height = max(40, height // 40)
+    for i, y in enumerate(range(line_height, height - line_height, line_height)):
+        draw.text(
+            (width // 12, y), f"{i + 1})  {14 + i} x {83 - i} =", fill=(25, 25, 25)
+        )
+        draw.line(
+            [(width // 3, y + line_height // 3), (width // 2, y + line_height // 4)],
+            fill=(30, 30, 140),
+            width=max(2, width // 500),
+        )
+    if orientation == 6:
+        # Stored rotated; orientation 6 tells the viewer to rotate it back
+        img = img.transpose(Image.ROTATE_90)
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=90, exif=exif.tobytes())
+    return buffer.getvalue()
+
+
+def load_corpus(corpus_dir=None):
+    """
+    Returns:
+        list: (name, encoded image bytes) pairs
+    """
+    if corpus_dir is None:
+        return [
+            (name, make_sheet(width, height, orientation))
+            for name, width, height, orientation in SYNTHETIC_SHEETS
+        ]
+    corpus = []
+    for file_name in sorted(os.listdir(corpus_dir)):
+        if file_name.lower().endswith((".jpg", ".jpeg", ".png")):
+            with open(os.path.join(corpus_dir, file_name), "rb") as f:
+                corpus.append((os.path.splitext(file_name)[0], f.read()))
+    return corpus
+
+
+def canned_response(width, height, spacing=120):
+    """A schema-valid model response with one question every `spacing` pixels."""
+    questions = [
+        {
+            "question": f"{14 + i} x {83 - i}",
+            "student_answer": str((14 + i) * (83 - i)),
+            "correct_answer": str((14 + i) * (83 - i)),
+            "correctness": i % 3 != 0,
+            "answer_written": True,
+            "coordinates_of_answer": {"x_coordinate": width // 2, "y_coordinate": y},
+        }
+        for i, y in enumerate(range(spacing, height - spacing // 2, spacing))
+    ]
+    return json.dumps(
+        {
+            "questions": questions,
+            "total_amount_of_questions": len(questions),
+            "correct_answers": sum(1 for q in questions if q["correctness"]),
+        },
+        indent=2,
+    )
+
+
+# --- Offline Gemini stand-in ---
+
+
+class _StubModels:
+    def __init__(self):
+        self.response_text = "{}"
+
+    def generate_content_stream(self, model, contents, config):
+        text = self.response_text
+        for i in range(0, len(text), STUB_CHUNK_SIZE):
+            yield SimpleNamespace(text=text[i : i + STUB_CHUNK_SIZE])
+
+
+class StubClient:
+    """Stands in for genai.Client; streams whatever response_text is set."""
+
+    def __init__(self):
+        self.models = _StubModels()
+
+
+# --- Measurement ---
+
+
+def _read_status_kb(field):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _use_mmap_for_large_allocations():
+    # glibc raises its mmap threshold after large frees and then keeps freed image
+    # buffers on the heap, which hides later allocations from the RSS peak.
+    # Pinning the threshold makes every large buffer a fresh, measurable mapping.
+    try:
+        import ctypes
+
+        libc = ctypes.CDLL("libc.so.6")
+        M_MMAP_THRESHOLD = -3
+        libc.mallopt(M_MMAP_THRESHOLD, 128 * 1024)
+    except (OSError, AttributeError):
+        pass
+
+
+def _reset_peak_rss():
+    # Linux only: resets VmHWM so it tracks the peak of the next stage alone
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class DiskWriteCounter:
+    """Counts bytes written through builtins.open (which Image.save uses)."""
+
+    def __init__(self):
+        self.bytes_written = 0
+        self._open = builtins.open
+
+    def __enter__(self):
+        counter = self
+        real_open = self._open
+
+        class CountingFile:
+            def __init__(self, f):
+                self._f = f
+
+            def write(self, data):
+                counter.bytes_written += len(data)
+                return self._f.write(data)
+
+            def __getattr__(self, name):
+                return getattr(self._f, name)
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return self._f.__exit__(*exc)
+
+            def __iter__(self):
+                return iter(self._f)
+
+        def counting_open(file, mode="r", *args, **kwargs):
+            f = real_open(file, mode, *args, **kwargs)
+            if any(flag in mode for flag in "wax+"):
+                return CountingFile(f)
+            return f
+
+        builtins.open = counting_open
+        return self
+
+    def __exit__(self, *exc):
+        builtins.open = self._open
+
+
+def measure(func, arg, repeats):
+    """
+    Run func(arg) `repeats` times.
+
+    Returns:
+        tuple: (result, stats dict with median_ms, min_ms, peak_mb, disk_bytes)
+    """
+    timings = []
+    with DiskWriteCounter() as disk:
+        for _ in range(repeats):
+            start = time.perf_counter()
+            result = func(arg)
+            timings.append((time.perf_counter() - start) * 1000)
+
+    # One extra run for memory, so tracing doesn't distort the timings
+    rss_before = _read_status_kb("VmRSS")
+    rss_reset = _reset_peak_rss()
+    tracemalloc.start()
+    func(arg)
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    peak_kb = _read_status_kb("VmHWM")
+    if rss_reset and peak_kb is not None and rss_before is not None:
+        # Process peak covers Pillow's native buffers, which tracemalloc can't see
+        peak_mb = max(peak_kb - rss_before, 0) / 1024
+    else:
+        peak_mb = traced_peak / (1024 * 1024)
+
+    return result, {
+        "median_ms": round(statistics.median(timings), 2),
+        "min_ms": round(min(timings), 2),
+        "peak_mb": round(peak_mb, 1),
+        "disk_bytes": disk.bytes_written // repeats,
+    }
+
+
+# --- Stages ---
+
+
+def run_sheet(image_bytes, stub, repeats):
+    """
+    Time every pipeline stage for one sheet, feeding each stage the output of
+    the previous one.
+
+    Returns:
+        dict: stage name -> stats
+    """
+    results = {}
+
+    def stage(name, func, arg):
+        output, results[name] = measure(func, arg, repeats)
+        return output
+
+    def decode(data):
+        image = load_image(data)
+        image.load()
+        return image
+
+    # The upload path in one step: draft decode, orientation and resize
+    stage(
+        "decode_upload",
+        lambda data: decode_upload(data, target_width=1024).image,
+        image_bytes,
+    )
+    image = stage("decode", decode, image_bytes)
+    image = stage("fix_image_orientation", fix_image_orientation, image)
+    image = stage(
+        "resize_image_width", lambda img: resize_image_width(img, 1024), image
+    )
+    stage("detect_page", detect_page, image)
+    stage(
+        "overlay_grid_on_image",
+        lambda img: overlay_grid_on_image(img, **GRID_SETTINGS),
+        image,
+    )
+    # Resize, grid and encode exactly as the app does before the model call
+    payload = stage(
+        "encode_payload", lambda img: build_payload(img, GRID_SETTINGS), image
+    )
+
+    stub.models.response_text = canned_response(payload.width, payload.height)
+    stage(
+        "generate_stubbed",
+        lambda data: geminigen.generate(
+            image=data,
+            prompt_text=INPUT_PROMPT,
+            api_key=STUB_API_KEY,
+            mime_type=payload.mime_type,
+        ),
+        payload.data,
+    )
+    grading_result = stage(
+        "parse_response", geminigen.parse_response, stub.models.response_text
+    )
+    stage("generate_marks_data", generate_marks_data, grading_result)
+    stage("grade", lambda img: grade(img, data=grading_result), image)
+    return results
+
+
+def run_suite(corpus, repeats):
+    _use_mmap_for_large_allocations()
+    stub = StubClient()
+    geminigen.client_manager.register(STUB_API_KEY, stub)
+
+    report = {}
+    for name, image_bytes in corpus:
+        report[name] = run_sheet(image_bytes, stub, repeats)
+    return report
+
+
+# --- Reporting ---
+
+
+def compare(report, baseline, tolerance):
+    """
+    Returns:
+        list: (sheet, stage, baseline_ms, current_ms) for every regression
+    """
+    regressions = []
+    for sheet, stages in report.items():
+        for stage_name, stats in stages.items():
+            previous = baseline.get(sheet, {}).get(stage_name)
+            if previous is None:
+                continue
+            slowdown = stats["median_ms"] - previous["median_ms"]
+            if (
+                stats["median_ms"] > previous["median_ms"] * (1 + tolerance)
+                and slowdown >= MIN_REGRESSION_MS
+            ):
+                regressions.append(
+                    (sheet, stage_name, previous["median_ms"], stats["median_ms"])
+                )
+    return regressions
+
+
+def print_report(report, baseline):
+    print(
+        f"{'sheet':<12} {'stage':<22} {'median ms':>10} {'baseline':>10} "
+        f"{'peak MB':>8} {'disk bytes':>11}"
+    )
+    for sheet, stages in report.items():
+        for stage_name, stats in stages.items():
+            previous = baseline.get(sheet, {}).get(stage_name)
+            previous_ms = f"{previous['median_ms']:.2f}" if previous else "-"
+            print(
+                f"{sheet:<12} {stage_name:<22} {stats['median_ms']:>10.2f} "
+                f"{previous_ms:>10} {stats['peak_mb']:>8.1f} {stats['disk_bytes']:>11}"
+            )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the grading pipeline.")
+    parser.add_argument("--corpus", help="Directory of sheets (default: synthetic)")
+    parser.add_argument("--repeats", type=int, default=DEFAULT_REPEATS)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help="Allowed slowdown before a stage is flagged (0.25 = 25%%)",
+    )
+    parser.add_argument(
+        "--save-baseline", action="store_true", help="Store this run as the baseline"
+    )
+    parser.add_argument("--json", help="Also write the report to this file")
+    args = parser.parse_args(argv)
+
+    report = run_suite(load_corpus(args.corpus), args.repeats)
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    print_report(report, baseline)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nBaseline saved to {args.baseline}")
+        return 0
+
+    if not baseline:
+        print("\nNo baseline found; run with --save-baseline to record one.")
+        return 0
+
+    regressions = compare(report, baseline, args.tolerance)
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) over {args.tolerance:.0%}:")
+        for sheet, stage_name, previous_ms, current_ms in regressions:
+            print(f"  {sheet} / {stage_name}: {previous_ms:.2f} -> {current_ms:.2f} ms")
+        return 1
+    print("\nNo regressions against the baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
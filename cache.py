@@ -0,0 +1,357 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import cached_property
+
+logger = logging.getLogger(__name__)
+
+# Cache settings
+MEMORY_MAX_BYTES = 16 * 1024 * 1024  # In-memory tier budget (16 MB)
+DISK_MAX_BYTES = 256 * 1024 * 1024  # On-disk tier budget (256 MB)
+CACHE_TTL_SECONDS = 7 * 24 * 60 * 60  # Entries expire after a week
+CACHE_DIR = os.path.join(tempfile.gettempdir(), "aigrader_response_cache")
+
+# Result store settings
+RESULT_STORE_MAX_BYTES = 128 * 1024 * 1024  # Graded results kept for all sessions
+RESULT_TTL_SECONDS = 60 * 60  # Results expire an hour after their last view
+# Decoded and encoded images reused across Streamlit reruns
+ARTIFACT_MAX_BYTES = 64 * 1024 * 1024
+
+
+def make_cache_key(*parts):
+    """
+    Build a content hash from the given parts (bytes or str).
+
+    Each part is length-prefixed so that ("ab", "c") and ("a", "bc") never collide.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        digest.update(len(part).to_bytes(8, "big"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+class MemoryCache:
+    """
+    Thread-safe LRU cache with a byte budget and a time-to-live.
+
+    Values are sized with len() unless a sizeof function is given.
+    """
+
+    def __init__(self, max_bytes=MEMORY_MAX_BYTES, ttl=CACHE_TTL_SECONDS, sizeof=len):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self._entries = OrderedDict()  # key -> (value, size, expires_at)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, size, expires_at = entry
+            if expires_at < time.time():
+                self._remove(key)
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            # Never let a single oversized value flush the whole cache
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.time() + self.ttl)
+            self._total_bytes += size
+            while self._total_bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def get_or_set(self, key, build):
+        """Return the cached value, calling build() to create it on a miss."""
+        value = self.get(key)
+        if value is None:
+            value = build()
+            self.set(key, value)
+        return value
+
+    def touch(self, key):
+        """Mark an entry as just used and restart its TTL, without re-sizing it."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            value, size, _ = entry
+            self._entries[key] = (value, size, time.time() + self.ttl)
+            self._entries.move_to_end(key)
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._remove(key)
+            return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._total_bytes -= size
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class DiskCache:
+    """
+    Directory of text files keyed by content hash, bounded by size and age.
+
+    File modification times double as last-access times, so eviction is
+    least-recently-used across processes sharing the directory.
+    """
+
+    def __init__(
+        self, directory=CACHE_DIR, max_bytes=DISK_MAX_BYTES, ttl=CACHE_TTL_SECONDS
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if os.path.getmtime(path) + self.ttl < time.time():
+                os.unlink(path)
+                with self._lock:
+                    self.evictions += 1
+                    self.misses += 1
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                value = f.read()
+            # Touch the file so eviction treats it as recently used
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(value)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("Could not write cache entry %s: %s", key, e)
+            return
+        self._evict()
+
+    def _evict(self):
+        """Drop expired files, then the least recently used until under budget."""
+        now = time.time()
+        files = []
+        total_bytes = 0
+        with self._lock:
+            for entry in os.scandir(self.directory):
+                if not entry.name.endswith(".json"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                if stat.st_mtime + self.ttl < now:
+                    self._unlink(entry.path)
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                total_bytes += stat.st_size
+
+            files.sort()
+            for _, size, path in files:
+                if total_bytes <= self.max_bytes:
+                    break
+                self._unlink(path)
+                total_bytes -= size
+
+    def _unlink(self, path):
+        try:
+            os.unlink(path)
+            self.evictions += 1
+        except OSError:
+            pass
+
+    def stats(self):
+        entries = 0
+        total_bytes = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                entries += 1
+                total_bytes += entry.stat().st_size
+        with self._lock:
+            return {
+                "entries": entries,
+                "bytes": total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class ResponseCache:
+    """
+    Two-tier cache for model responses: an in-memory LRU in front of a disk cache.
+
+    Disk hits are promoted into memory so repeated reruns stay in-process.
+    """
+
+    def __init__(self, memory=None, disk=None):
+        self.memory = memory if memory is not None else MemoryCache()
+        self.disk = disk if disk is not None else DiskCache()
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            return value
+        value = self.disk.get(key)
+        if value is not None:
+            self.memory.set(key, value)
+        return value
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        self.disk.set(key, value)
+
+    def stats(self):
+        memory = self.memory.stats()
+        disk = self.disk.stats()
+        lookups = memory["hits"] + memory["misses"]
+        hits = memory["hits"] + disk["hits"]
+        return {
+            "lookups": lookups,
+            "hits": hits,
+            "misses": lookups - hits,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "memory": memory,
+            "disk": disk,
+        }
+
+
+def artifact_size(value):
+    """Approximate memory held by bytes, PIL images or tuples of them."""
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    if isinstance(value, tuple):
+        return sum(artifact_size(item) for item in value)
+    if hasattr(value, "getbands"):
+        return value.width * value.height * len(value.getbands())
+    return 0
+
+
+@dataclass(frozen=True)
+class StoredResult:
+    """A finished grading: the encoded graded output and its parsed result."""
+
+    graded: bytes  # Encoded graded image, or the graded PDF of a document
+    mime_type: str
+    result: object  # GradingResult or DocumentResult
+
+    @cached_property
+    def size(self):
+        return len(self.graded) + len(json.dumps(self.result.to_dict()))
+
+
+class ResultStore:
+    """
+    Finished gradings shared by every session, held in memory only.
+
+    Sessions keep just the key (the grading job ID). The store has one byte
+    budget for all of them and drops the least recently viewed results first,
+    or once they haven't been viewed for the TTL, so nothing piles up when a
+    browser goes away without resetting.
+    """
+
+    def __init__(self, max_bytes=RESULT_STORE_MAX_BYTES, ttl=RESULT_TTL_SECONDS):
+        self._entries = MemoryCache(
+            max_bytes=max_bytes, ttl=ttl, sizeof=lambda stored: stored.size
+        )
+
+    def put(self, key, graded, mime_type, result):
+        stored = StoredResult(graded=graded, mime_type=mime_type, result=result)
+        self._entries.set(key, stored)
+        logger.debug("Stored result %s (%d bytes)", key[:8], stored.size)
+        return stored
+
+    def get(self, key):
+        """Return the StoredResult, or None if it was evicted or has expired."""
+        if key is None:
+            return None
+        stored = self._entries.get(key)
+        if stored is not None:
+            # Viewing a result keeps it alive for another TTL
+            self._entries.touch(key)
+        return stored
+
+    def pop(self, key):
+        if key is None:
+            return None
+        return self._entries.pop(key)
+
+    def stats(self):
+        return self._entries.stats()
+
+
+# Process-wide cache shared by every Streamlit session
+response_cache = ResponseCache()
+
+# Graded results of every session, by grading job ID
+result_store = ResultStore()
+
+# Rerun-stable page artifacts (decoded crops, encoded previews), by content hash
+artifact_cache = MemoryCache(
+    max_bytes=ARTIFACT_MAX_BYTES, ttl=RESULT_TTL_SECONDS, sizeof=artifact_size
+)
@@ -1,23 +1,131 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
+from pymongo.write_concern import WriteConcern
 from datetime import datetime
+import functools
+import threading
+import time
 import streamlit as st
 
+# Limits used when a counter document is first created
+DEFAULT_DAILY_LIMIT = 10
+DEFAULT_MONTHLY_LIMIT = 300
 
-def get_database():
+# Connection pool defaults (override with the matching keys in secrets.toml)
+DEFAULT_MAX_POOL_SIZE = 10
+DEFAULT_SERVER_SELECTION_TIMEOUT_MS = 5000
+DEFAULT_CONNECT_TIMEOUT_MS = 5000
+DEFAULT_SOCKET_TIMEOUT_MS = 10000
+
+# Per-thread record of time spent in MongoDB for the current request
+_timing = threading.local()
+
+
+@st.cache_resource(show_spinner=False)
+def get_client():
     """
-    Connect to MongoDB and return the database object.
-    Uses environment variable MONGODB_URI if available, otherwise uses a default local connection.
+    Return the process-wide MongoClient, creating it on first use.
+
+    The client (and its connection pool) is shared by every Streamlit session and
+    rerun, so TLS and server discovery happen once per process instead of on
+    every counter read.
     """
-    # Get MongoDB URI from environment variable or use default
+    # Get MongoDB URI from Streamlit secrets
     mongodb_uri = st.secrets["MONGODB_URI"]
 
-    # Connect to MongoDB
-    client = MongoClient(mongodb_uri)
+    return MongoClient(
+        mongodb_uri,
+        maxPoolSize=st.secrets.get("MONGODB_MAX_POOL_SIZE", DEFAULT_MAX_POOL_SIZE),
+        serverSelectionTimeoutMS=st.secrets.get(
+            "MONGODB_SERVER_SELECTION_TIMEOUT_MS", DEFAULT_SERVER_SELECTION_TIMEOUT_MS
+        ),
+        connectTimeoutMS=st.secrets.get(
+            "MONGODB_CONNECT_TIMEOUT_MS", DEFAULT_CONNECT_TIMEOUT_MS
+        ),
+        socketTimeoutMS=st.secrets.get(
+            "MONGODB_SOCKET_TIMEOUT_MS", DEFAULT_SOCKET_TIMEOUT_MS
+        ),
+        appname="homework-grader",
+    )
 
+
+def get_database():
+    """
+    Return the usage tracker database on the shared client.
+    """
     # Return database (create if it doesn't exist)
-    return client["usage_tracker"]
+    return get_client()["usage_tracker"]
+
+
+def check_health():
+    """
+    Ping the MongoDB server.
+
+    Returns:
+        dict: ok (bool), latency_ms (float) and error (str or None)
+    """
+    start = time.perf_counter()
+    try:
+        get_client().admin.command("ping")
+        error = None
+    except Exception as e:
+        error = str(e)
+    return {
+        "ok": error is None,
+        "latency_ms": (time.perf_counter() - start) * 1000,
+        "error": error,
+    }
+
+
+def _timed(func):
+    """Add the wall time of a counter operation to the current thread's timing."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # Nested calls (update_counter -> read_counter) are only counted once
+        depth = getattr(_timing, "depth", 0)
+        _timing.depth = depth + 1
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _timing.depth = depth
+            if depth == 0:
+                _timing.seconds = getattr(_timing, "seconds", 0.0) + (
+                    time.perf_counter() - start
+                )
+                _timing.calls = getattr(_timing, "calls", 0) + 1
+
+    return wrapper
 
 
+def reset_mongo_timing():
+    """Start measuring MongoDB time for a new request on this thread."""
+    _timing.seconds = 0.0
+    _timing.calls = 0
+
+
+def get_mongo_timing():
+    """
+    Returns:
+        dict: seconds spent in counter operations and number of operations since
+            the last reset_mongo_timing on this thread
+    """
+    return {
+        "seconds": getattr(_timing, "seconds", 0.0),
+        "calls": getattr(_timing, "calls", 0),
+    }
+
+
+def add_mongo_timing(timing):
+    """
+    Add timing measured on another thread (e.g. a tiled-grading worker) to this
+    thread's request.
+    """
+    _timing.seconds = getattr(_timing, "seconds", 0.0) + timing["seconds"]
+    _timing.calls = getattr(_timing, "calls", 0) + timing["calls"]
+
+
+@_timed
 def read_counter(counter_id="gemini_api"):
     """
     Read the current counter value from MongoDB.
@@ -53,8 +161,8 @@ def read_counter(counter_id="gemini_api"):
             "daily": {"date": current_date, "count": 0},
             "monthly": {"month": current_month, "count": 0},
             "limits": {
-                "daily": 10,  # Default daily limit
-                "monthly": 300,  # Default monthly limit
+                "daily": DEFAULT_DAILY_LIMIT,
+                "monthly": DEFAULT_MONTHLY_LIMIT,
             },
         }
         counters.insert_one(counter_doc)
@@ -98,7 +206,10 @@ def read_counter(counter_id="gemini_api"):
     return response
 
 
+@_timed
 def update_counter(counter_id="gemini_api"):
+    # Kept for callers that count after the fact; the grading path uses
+    # reserve_quota/refund_quota instead.
 
     # First check current counter values
     current = read_counter(counter_id)
@@ -122,3 +233,179 @@ def update_counter(counter_id="gemini_api"):
     )
 
     return
+
+
+def _counter_response(counter_doc):
+    # Same shape as read_counter's response
+    daily_limit = counter_doc["limits"]["daily"]
+    monthly_limit = counter_doc["limits"]["monthly"]
+    daily_count = counter_doc["daily"]["count"]
+    monthly_count = counter_doc["monthly"]["count"]
+    return {
+        "daily_count": daily_count,
+        "monthly_count": monthly_count,
+        "daily_limit": daily_limit,
+        "monthly_limit": monthly_limit,
+        "daily_remaining": max(0, daily_limit - daily_count),
+        "monthly_remaining": max(0, monthly_limit - monthly_count),
+        "can_make_request": (daily_count < daily_limit)
+        and (monthly_count < monthly_limit),
+    }
+
+
+def _log_usage(db, counter_id, usage_type):
+    # Unacknowledged write: the usage log never adds a round trip to the hot path
+    db["usage_log"].with_options(write_concern=WriteConcern(w=0)).insert_one(
+        {"counter_id": counter_id, "timestamp": datetime.now(), "type": usage_type}
+    )
+
+
+@_timed
+def reserve_quota(counter_id="gemini_api"):
+    """
+    Atomically take one slot from the daily and monthly quota.
+
+    The day/month reset, the limit check and the increment all happen in a single
+    find_one_and_update with an update pipeline, so concurrent sessions can never
+    both pass the check and go over the limit.
+
+    Args:
+        counter_id (str): Identifier for the counter (default: "gemini_api")
+
+    Returns:
+        dict: read_counter's fields after the reservation, plus:
+            - reserved: True if a slot was taken
+            - date / month: The period the slot was taken from (for refund_quota)
+    """
+    db = get_database()
+
+    now = datetime.now()
+    current_date = now.strftime("%Y-%m-%d")
+    current_month = now.strftime("%Y-%m")
+
+    counter_doc = db["counters"].find_one_and_update(
+        {"_id": counter_id},
+        [
+            # Start a new period if the stored one is over, and fill in defaults
+            # for a counter that doesn't exist yet
+            {
+                "$set": {
+                    "daily": {
+                        "$cond": [
+                            {"$eq": ["$daily.date", current_date]},
+                            "$daily",
+                            {"date": current_date, "count": 0},
+                        ]
+                    },
+                    "monthly": {
+                        "$cond": [
+                            {"$eq": ["$monthly.month", current_month]},
+                            "$monthly",
+                            {"month": current_month, "count": 0},
+                        ]
+                    },
+                    "limits": {
+                        "$ifNull": [
+                            "$limits",
+                            {
+                                "daily": DEFAULT_DAILY_LIMIT,
+                                "monthly": DEFAULT_MONTHLY_LIMIT,
+                            },
+                        ]
+                    },
+                }
+            },
+            # Check both limits
+            {
+                "$set": {
+                    "last_reserved": {
+                        "$and": [
+                            {"$lt": ["$daily.count", "$limits.daily"]},
+                            {"$lt": ["$monthly.count", "$limits.monthly"]},
+                        ]
+                    }
+                }
+            },
+            # Increment only if the check passed
+            {
+                "$set": {
+                    "daily.count": {
+                        "$add": [
+                            "$daily.count",
+                            {"$cond": ["$last_reserved", 1, 0]},
+                        ]
+                    },
+                    "monthly.count": {
+                        "$add": [
+                            "$monthly.count",
+                            {"$cond": ["$last_reserved", 1, 0]},
+                        ]
+                    },
+                }
+            },
+        ],
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+
+    response = _counter_response(counter_doc)
+    response["reserved"] = counter_doc["last_reserved"]
+    response["date"] = current_date
+    response["month"] = current_month
+
+    if response["reserved"]:
+        _log_usage(db, counter_id, "api_call")
+
+    return response
+
+
+@_timed
+def refund_quota(reservation, counter_id="gemini_api"):
+    """
+    Give back a slot taken by reserve_quota, e.g. when the model call failed.
+
+    Only the periods the slot was taken from are decremented, so a refund that
+    lands after midnight doesn't touch the new day's count.
+
+    Args:
+        reservation (dict): The value returned by reserve_quota
+        counter_id (str): Identifier for the counter (default: "gemini_api")
+    """
+    if not reservation or not reservation["reserved"]:
+        return
+
+    db = get_database()
+    db["counters"].update_one(
+        {"_id": counter_id},
+        [
+            {
+                "$set": {
+                    "daily.count": {
+                        "$cond": [
+                            {
+                                "$and": [
+                                    {"$eq": ["$daily.date", reservation["date"]]},
+                                    {"$gt": ["$daily.count", 0]},
+                                ]
+                            },
+                            {"$subtract": ["$daily.count", 1]},
+                            "$daily.count",
+                        ]
+                    },
+                    "monthly.count": {
+                        "$cond": [
+                            {
+                                "$and": [
+                                    {"$eq": ["$monthly.month", reservation["month"]]},
+                                    {"$gt": ["$monthly.count", 0]},
+                                ]
+                            },
+                            {"$subtract": ["$monthly.count", 1]},
+                            "$monthly.count",
+                        ]
+                    },
+                }
+            }
+        ],
+    )
+    _log_usage(db, counter_id, "refund")
@@ -0,0 +1,381 @@
+import logging
+import time
+from dataclasses import dataclass
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from tracing import set_attribute, span
+from utils import image_to_bytes, load_image, resize_image_width
+
+logger = logging.getLogger(__name__)
+
+# The cropper is shown a small JPEG proxy of the sheet instead of the sheet
+CROP_SETTINGS = {
+    "proxy_width": 512,  # Width of the proxy sent to the browser
+    "proxy_quality": 70,  # JPEG quality of the proxy
+    # A crop is only placed if its best match in the proxy has at most this mean
+    # squared error per channel...
+    "max_match_error": 400.0,
+    # ...and every match more than `match_radius` px away from it has an error
+    # of at least `match_ratio` times the best plus `match_margin` (otherwise
+    # the crop is ambiguous, e.g. a blank or repeating area)
+    "match_ratio": 1.5,
+    "match_margin": 1.0,
+    "match_radius": 2,
+}
+
+# Page detection runs on a small grayscale copy of the working image
+DETECT_SETTINGS = {
+    "detect_width": 512,  # Width the edges are searched at
+    "canny_low": 50,  # Canny hysteresis thresholds
+    "canny_high": 150,
+    "min_area": 0.3,  # The page must cover at least this fraction of the photo
+    "approx_epsilon": 0.02,  # Polygon simplification, as a fraction of perimeter
+    # The page must stand out from what surrounds it: the median brightness of
+    # a band just outside its edge (`border_width` of the detect width) must
+    # differ from a band just inside by at least `min_contrast` grey levels...
+    "border_width": 0.02,
+    "min_contrast": 30,
+    # ...and at least `min_border` of that outside band must be in the photo (a
+    # quad that runs off the frame has no background to compare against)
+    "min_border": 0.5,
+}
+
+
+class CropNotFoundError(Exception):
+    """Raised when a crop can't be placed reliably on the image it came from."""
+
+
+@dataclass(frozen=True)
+class CropProxy:
+    """
+    The downscaled image shown in the cropper.
+
+    `scale` is proxy pixels per full-resolution pixel.
+    """
+
+    data: bytes
+    width: int
+    height: int
+    scale: float
+
+
+def make_proxy(image, settings=None):
+    """
+    Encode a small JPEG of the sheet for the cropper, so what the browser
+    downloads doesn't grow with the sheet's resolution.
+
+    Returns:
+        CropProxy: The encoded proxy and its scale
+    """
+    settings = {**CROP_SETTINGS, **(settings or {})}
+    img = load_image(image).convert("RGB")
+    proxy = img
+    if img.width > settings["proxy_width"]:
+        proxy = resize_image_width(img, target_width=settings["proxy_width"])
+    return CropProxy(
+        data=image_to_bytes(proxy, format="JPEG", quality=settings["proxy_quality"]),
+        width=proxy.width,
+        height=proxy.height,
+        scale=proxy.width / img.width,
+    )
+
+
+def locate_crop(proxy_image, cropped_image, settings=None):
+    """
+    Find where the cropper's output sits in the proxy it was cut from.
+
+    The cropper returns pixels rather than a rectangle, so the crop is matched
+    back against the proxy (squared difference over all positions). The browser
+    decodes the JPEG proxy slightly differently from Pillow, which is why this
+    looks for the best match rather than an exact one.
+
+    Raises:
+        CropNotFoundError: If the best match is poor, or another position
+            matches about as well (a blank or repetitive area)
+
+    Returns:
+        tuple: (left, top, right, bottom) in proxy pixels
+    """
+    settings = {**CROP_SETTINGS, **(settings or {})}
+    proxy = np.asarray(load_image(proxy_image).convert("RGB"), dtype=np.float32)
+    crop = np.asarray(load_image(cropped_image).convert("RGB"), dtype=np.float32)
+    height, width = crop.shape[:2]
+    # The crop can't be larger than the proxy; clip rounding overshoot
+    height = min(height, proxy.shape[0])
+    width = min(width, proxy.shape[1])
+    crop = crop[:height, :width]
+    if (height, width) == proxy.shape[:2]:
+        return 0, 0, width, height
+
+    # Mean squared error per channel at every position
+    errors = cv2.matchTemplate(proxy, crop, cv2.TM_SQDIFF) / (width * height * 3)
+    best, _, (left, top), _ = cv2.minMaxLoc(errors)
+
+    # The runner-up outside the best match's immediate neighbourhood
+    radius = settings["match_radius"]
+    errors[
+        max(0, top - radius) : top + radius + 1,
+        max(0, left - radius) : left + radius + 1,
+    ] = np.inf
+    runner_up = float(errors.min())
+    logger.debug(
+        "Crop %dx%d matched at (%d, %d), error %.1f, runner-up %.1f",
+        width,
+        height,
+        left,
+        top,
+        best,
+        runner_up,
+    )
+
+    if best > settings["max_match_error"]:
+        raise CropNotFoundError(f"The crop doesn't match the photo (error {best:.0f}).")
+    if runner_up < best * settings["match_ratio"] + settings["match_margin"]:
+        raise CropNotFoundError(
+            "The cropped area looks the same in more than one place."
+        )
+    return left, top, left + width, top + height
+
+
+def map_rect(rect, scale, size):
+    """
+    Map a proxy rectangle onto the full-resolution image, clamped to its size.
+
+    Returns:
+        tuple: (left, top, right, bottom) in full-resolution pixels
+    """
+    width, height = size
+    left, top, right, bottom = (round(value / scale) for value in rect)
+    return (
+        max(0, left),
+        max(0, top),
+        min(width, max(right, left + 1)),
+        min(height, max(bottom, top + 1)),
+    )
+
+
+def crop_full_resolution(image, proxy, cropped_image):
+    """
+    Apply the crop the user made on the proxy to the full-resolution image.
+
+    Args:
+        image: Full-resolution PIL image the proxy was made from
+        proxy (CropProxy): The proxy shown in the cropper
+        cropped_image: The cropper's output (encoded bytes or PIL image)
+
+    Returns:
+        tuple: (cropped PIL image, (left, top, right, bottom) in image pixels)
+    """
+    with span("crop", proxy_width=proxy.width) as crop_span:
+        rect = map_rect(locate_crop(proxy.data, cropped_image), proxy.scale, image.size)
+        crop_span.set("rect", rect)
+        return image.crop(rect), rect
+
+
+@dataclass(frozen=True)
+class PageDetection:
+    """
+    The sheet found in a photo, straightened and cut out of the background.
+
+    `corners` are the page corners in the working image (top-left, top-right,
+    bottom-right, bottom-left); `image` and `corners` are None when no page
+    was found.
+    """
+
+    image: Image.Image
+    corners: tuple
+    coverage: float
+    detect_ms: float
+
+    @property
+    def found(self):
+        return self.image is not None
+
+    def describe(self):
+        """Summary of the detection (for traces and logs)."""
+        summary = {
+            "page_found": self.found,
+            "page_coverage": round(self.coverage, 2),
+            "detect_ms": round(self.detect_ms, 1),
+        }
+        if self.found:
+            summary["page_size"] = "x".join(map(str, self.image.size))
+        return summary
+
+
+def _order_corners(points):
+    # Top-left has the smallest x + y, bottom-right the largest; top-right has
+    # the smallest y - x, bottom-left the largest
+    points = np.asarray(points, dtype=np.float32).reshape(4, 2)
+    sums = points.sum(axis=1)
+    diffs = np.diff(points, axis=1).ravel()
+    return np.array(
+        [
+            points[np.argmin(sums)],
+            points[np.argmin(diffs)],
+            points[np.argmax(sums)],
+            points[np.argmax(diffs)],
+        ],
+        dtype=np.float32,
+    )
+
+
+def _has_background(gray, corners, settings):
+    # A table or answer box on a borderless scan is also a closed four-sided
+    # contour, but it is surrounded by the page rather than by background
+    width = max(3, round(settings["border_width"] * gray.shape[1]))
+    kernel = np.ones((2 * width + 1, 2 * width + 1), np.uint8)
+    # Pad so the outside band isn't clipped by the frame before it is measured
+    mask = np.zeros((gray.shape[0] + 2 * width, gray.shape[1] + 2 * width), np.uint8)
+    cv2.fillConvexPoly(mask, np.round(corners + width).astype(np.int32), 255)
+    outside = (cv2.dilate(mask, kernel) > 0) & (mask == 0)
+    inside = (mask > 0) & (cv2.erode(mask, kernel) == 0)
+    in_frame = outside[width:-width, width:-width]
+    inside = inside[width:-width, width:-width]
+    if not inside.any() or in_frame.sum() < settings["min_border"] * outside.sum():
+        return False
+    contrast = abs(float(np.median(gray[in_frame])) - float(np.median(gray[inside])))
+    logger.debug("Page candidate border contrast %.0f", contrast)
+    return contrast >= settings["min_contrast"]
+
+
+def find_page_corners(gray, settings=None):
+    """
+    Find the outline of the sheet in a grayscale image.
+
+    The largest convex four-sided contour with background around it is taken
+    as the page. If the edges don't close into one (a thumb over a corner, a
+    curled page), no page is reported: the box around an open contour is as
+    likely to be a figure as the sheet.
+
+    Args:
+        gray (numpy.ndarray): 8-bit grayscale image
+        settings (dict): Overrides for DETECT_SETTINGS
+
+    Returns:
+        tuple: (corners as a 4x2 float32 array in `gray` pixels or None,
+            fraction of the image the page covers)
+    """
+    settings = {**DETECT_SETTINGS, **(settings or {})}
+    min_area = settings["min_area"] * gray.shape[0] * gray.shape[1]
+
+    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+    edges = cv2.Canny(blurred, settings["canny_low"], settings["canny_high"])
+    # Close small gaps in the page edge
+    edges = cv2.dilate(edges, np.ones((3, 3), np.uint8))
+    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    contours = sorted(contours, key=cv2.contourArea, reverse=True)[:5]
+
+    for contour in contours:
+        area = cv2.contourArea(contour)
+        if area < min_area:
+            break
+        epsilon = settings["approx_epsilon"] * cv2.arcLength(contour, True)
+        approx = cv2.approxPolyDP(contour, epsilon, True)
+        if len(approx) == 4 and cv2.isContourConvex(approx):
+            corners = _order_corners(approx)
+            if _has_background(gray, corners, settings):
+                return corners, area / (gray.shape[0] * gray.shape[1])
+    return None, 0.0
+
+
+def warp_page(image, corners):
+    """
+    Cut the page out of the image and map its corners onto an upright
+    rectangle, which removes both the perspective and any skew.
+
+    Returns:
+        PIL.Image: The straightened page
+    """
+    top_left, top_right, bottom_right, bottom_left = corners
+    width = round(
+        max(
+            np.linalg.norm(top_right - top_left),
+            np.linalg.norm(bottom_right - bottom_left),
+        )
+    )
+    height = round(
+        max(
+            np.linalg.norm(bottom_left - top_left),
+            np.linalg.norm(bottom_right - top_right),
+        )
+    )
+    target = np.array(
+        [[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]],
+        dtype=np.float32,
+    )
+    matrix = cv2.getPerspectiveTransform(corners, target)
+    warped = cv2.warpPerspective(
+        np.asarray(image.convert("RGB")),
+        matrix,
+        (width, height),
+        flags=cv2.INTER_LINEAR,
+        borderMode=cv2.BORDER_REPLICATE,
+    )
+    return Image.fromarray(warped)
+
+
+def detect_page(image, settings=None):
+    """
+    Find the sheet in an upright, resized photo (the output of decode_upload),
+    then perspective-correct it and trim the background around it.
+
+    Edges are searched on a small grayscale copy; only the final warp touches
+    the working image.
+
+    Args:
+        image: Upright PIL image at the working width
+        settings (dict): Overrides for DETECT_SETTINGS
+
+    Returns:
+        PageDetection: The straightened page (if found) and how long it took
+    """
+    settings = {**DETECT_SETTINGS, **(settings or {})}
+    start = time.perf_counter()
+    with span("detect_page") as detect_span:
+        small = image.convert("L")
+        if small.width > settings["detect_width"]:
+            small = resize_image_width(small, target_width=settings["detect_width"])
+        corners, coverage = find_page_corners(np.asarray(small), settings)
+
+        page = None
+        if corners is not None:
+            corners = corners * (image.width / small.width)
+            page = warp_page(image, corners)
+            corners = tuple(tuple(round(float(v)) for v in point) for point in corners)
+
+        detection = PageDetection(
+            image=page,
+            corners=corners,
+            coverage=coverage,
+            detect_ms=(time.perf_counter() - start) * 1000,
+        )
+        for key, value in detection.describe().items():
+            detect_span.set(key, value)
+        set_attribute("detect_ms", round(detection.detect_ms, 1))
+    logger.info("Page detection: %s", detection.describe())
+    return detection
+
+
+def rect_corners(rect):
+    """Corners of a (left, top, right, bottom) rectangle, in detect_page order."""
+    left, top, right, bottom = rect
+    return ((left, top), (right, top), (right, bottom), (left, bottom))
+
+
+def region_iou(corners, other_corners):
+    """
+    Intersection over union of two convex quadrilaterals, such as a crop
+    rectangle (see rect_corners) and a detected page.
+
+    Returns:
+        float: 0 (disjoint) to 1 (identical)
+    """
+    first = np.asarray(corners, dtype=np.float32)
+    second = np.asarray(other_corners, dtype=np.float32)
+    intersection, _ = cv2.intersectConvexConvex(first, second)
+    union = cv2.contourArea(first) + cv2.contourArea(second) - intersection
+    return float(intersection / union) if union > 0 else 0.0
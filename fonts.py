@@ -0,0 +1,76 @@
+import logging
+from functools import lru_cache
+from PIL import Image, ImageDraw, ImageFont
+
+logger = logging.getLogger(__name__)
+
+# Places to look for Arial, in order. The first one that loads is used for every
+# size; if none does, Pillow's built-in font is used instead.
+FONT_CANDIDATES = [
+    "arial.ttf",
+    "Arial.ttf",
+    "C:/Windows/Fonts/arial.ttf",
+    "/Library/Fonts/Arial.ttf",
+    "/System/Library/Fonts/Supplemental/Arial.ttf",
+    "/usr/share/fonts/truetype/msttcorefonts/Arial.ttf",
+]
+
+
+@lru_cache(maxsize=1)
+def resolve_font_path():
+    """
+    Find the grading font once per process.
+
+    Returns:
+        str: Path of the first loadable candidate, or None to use Pillow's default
+    """
+    for candidate in FONT_CANDIDATES:
+        try:
+            ImageFont.truetype(candidate, 10)
+            return candidate
+        except OSError:
+            continue
+    logger.warning("Arial not found - using Pillow's default font")
+    return None
+
+
+@lru_cache(maxsize=None)
+def get_font(size):
+    """Return the shared font at the given size (loaded once per size)."""
+    font_path = resolve_font_path()
+    if font_path is not None:
+        return ImageFont.truetype(font_path, size)
+    try:
+        # Pillow >= 10.1 can scale the default font
+        return ImageFont.load_default(size)
+    except TypeError:
+        return ImageFont.load_default()
+
+
+@lru_cache(maxsize=2048)
+def render_text(text, size, fill):
+    """
+    Rasterise text once and cache the bitmap (the label atlas).
+
+    The bitmap keeps the text's offset from the draw origin, so pasting it at
+    (x, y) matches draw.text((x, y), text) exactly.
+
+    Returns:
+        Image: RGBA bitmap; shared between callers, so never modify it
+    """
+    font = get_font(size)
+    _, _, right, bottom = font.getbbox(text)
+    bitmap = Image.new("RGBA", (max(1, right), max(1, bottom)), (0, 0, 0, 0))
+    ImageDraw.Draw(bitmap).text((0, 0), text, fill=fill, font=font)
+    return bitmap
+
+
+def stamp_text(image, position, text, size, fill):
+    """
+    Stamp cached text onto an image at `position` (same placement as draw.text).
+    """
+    bitmap = render_text(text, size, fill)
+    if image.mode == "RGBA":
+        image.alpha_composite(bitmap, dest=position)
+    else:
+        image.paste(bitmap, position, bitmap)
@@ -1,144 +1,328 @@
-import base64
+import logging
 import os
-import json
+import threading
+import time
+from contextlib import contextmanager
 from google import genai
 from google.genai import types
+from PIL import Image
+from cache import make_cache_key
+from results import GradingResult, QuestionStreamParser, ResponseValidationError
+from tracing import span
+from utils import image_to_bytes
 
+logger = logging.getLogger(__name__)
 
-def generate(image_path=None, prompt_text="", api_key=None):
-    if not api_key:
-        raise ValueError("API key is required")
+MODEL = "gemini-2.5-flash-preview-04-17"
 
-    client = genai.Client(
-        api_key=api_key,
+RESPONSE_SCHEMA = genai.types.Schema(
+    type=genai.types.Type.OBJECT,
+    required=[
+        "questions",
+        "total_amount_of_questions",
+        "correct_answers",
+    ],
+    properties={
+        "questions": genai.types.Schema(
+            type=genai.types.Type.ARRAY,
+            items=genai.types.Schema(
+                type=genai.types.Type.OBJECT,
+                required=[
+                    "question",
+                    "student_answer",
+                    "correct_answer",
+                    "correctness",
+                    "answer_written",
+                    "coordinates_of_answer",
+                ],
+                properties={
+                    "question": genai.types.Schema(
+                        type=genai.types.Type.STRING,
+                    ),
+                    "student_answer": genai.types.Schema(
+                        type=genai.types.Type.STRING,
+                    ),
+                    "correct_answer": genai.types.Schema(
+                        type=genai.types.Type.STRING,
+                    ),
+                    "correctness": genai.types.Schema(
+                        type=genai.types.Type.BOOLEAN,
+                    ),
+                    "answer_written": genai.types.Schema(
+                        type=genai.types.Type.BOOLEAN,
+                    ),
+                    "coordinates_of_answer": genai.types.Schema(
+                        type=genai.types.Type.OBJECT,
+                        required=["x_coordinate", "y_coordinate"],
+                        properties={
+                            "x_coordinate": genai.types.Schema(
+                                type=genai.types.Type.INTEGER,
+                            ),
+                            "y_coordinate": genai.types.Schema(
+                                type=genai.types.Type.INTEGER,
+                            ),
+                        },
+                    ),
+                },
+            ),
+        ),
+        "total_amount_of_questions": genai.types.Schema(
+            type=genai.types.Type.INTEGER,
+        ),
+        "correct_answers": genai.types.Schema(
+            type=genai.types.Type.INTEGER,
+        ),
+    },
+)
+
+# Built once and reused by every request
+GENERATE_CONTENT_CONFIG = types.GenerateContentConfig(
+    thinking_config=types.ThinkingConfig(thinking_budget=8000),
+    response_mime_type="application/json",
+    response_schema=RESPONSE_SCHEMA,
+)
+# Part of every response cache key
+RESPONSE_SCHEMA_JSON = RESPONSE_SCHEMA.model_dump_json(exclude_none=True)
+
+
+def response_cache_key(image_data, prompt_text):
+    """
+    Content hash of everything that determines the model response:
+    the image bytes sent, the prompt, the model name and the response schema.
+    """
+    return make_cache_key(
+        image_data,
+        prompt_text,
+        MODEL,
+        RESPONSE_SCHEMA_JSON,
     )
 
-    model = "gemini-2.5-flash-preview-04-17"
 
+def parse_response(json_text):
+    """
+    Parse and validate model JSON output into a GradingResult.
+
+    Raises:
+        ResponseValidationError: If the output is not valid JSON or does not
+            match RESPONSE_SCHEMA
+    """
+    with span("parse", response_chars=len(json_text)):
+        return GradingResult.from_json(json_text, schema=RESPONSE_SCHEMA)
+
+
+def encode_image(image, mime_type="image/png"):
+    """
+    Return (bytes, mime_type) for the image payload without touching disk
+    unless `image` is a file path.
+    """
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return bytes(image), mime_type
+    if isinstance(image, Image.Image):
+        return image_to_bytes(image, format="PNG"), "image/png"
+    with open(image, "rb") as image_file:
+        return image_file.read(), mime_type
+
+
+class ClientManager:
+    """
+    Long-lived genai clients, one per API key.
+
+    A client owns the HTTP connection pools (sync and async), so reusing it
+    avoids client construction and a fresh TLS handshake on every grading.
+
+    Set GEMINI_BASE_URL to send requests somewhere other than the public API,
+    e.g. the offline stand-in in benchmarks/standin.py.
+    """
+
+    def __init__(self, base_url=None):
+        self.base_url = base_url or os.environ.get("GEMINI_BASE_URL") or None
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get(self, api_key):
+        if not api_key:
+            raise ValueError("API key is required")
+        with self._lock:
+            client = self._clients.get(api_key)
+            if client is None:
+                http_options = None
+                if self.base_url:
+                    http_options = types.HttpOptions(base_url=self.base_url)
+                client = genai.Client(api_key=api_key, http_options=http_options)
+                self._clients[api_key] = client
+            return client
+
+    def register(self, api_key, client):
+        """Use `client` for `api_key` from now on (e.g. an offline stand-in)."""
+        with self._lock:
+            self._clients[api_key] = client
+
+
+# Process-wide client manager shared by the app, the batch CLI and async callers
+client_manager = ClientManager()
+
+
+def _build_contents(image, prompt_text, mime_type):
+    # Returns None if the image can't be read
     parts = []
-    if image_path:
+    if image is not None:
         try:
-            with open(image_path, "rb") as image_file:
-                image_data = image_file.read()
-            # Encode the image data as base64
-            image_base64 = base64.b64encode(image_data).decode("utf-8")
+            image_data, mime_type = encode_image(image, mime_type)
             parts.append(
                 types.Part.from_bytes(
-                    mime_type="""image/jpeg""",
-                    data=base64.b64decode(image_base64),
+                    mime_type=mime_type,
+                    data=image_data,
                 )
             )
         except FileNotFoundError:
-            print(f"Error: Image file not found at {image_path}")
-            return  # Exit if image file is not found
+            logger.error("Image file not found at %s", image)
+            return None
         except Exception as e:
-            print(f"Error reading image file: {e}")
-            return
+            logger.error("Error reading image file: %s", e)
+            return None
 
     if prompt_text:
         parts.append(types.Part.from_text(text=prompt_text))
 
-    contents = [
+    return [
         types.Content(
             role="user",
             parts=parts,
         ),
     ]
 
-    generate_content_config = types.GenerateContentConfig(
-        thinking_config=types.ThinkingConfig(thinking_budget=8000),
-        response_mime_type="application/json",
-        response_schema=genai.types.Schema(
-            type=genai.types.Type.OBJECT,
-            required=[
-                "questions",
-                "total_amount_of_questions",
-                "correct_answers",
-            ],
-            properties={
-                "questions": genai.types.Schema(
-                    type=genai.types.Type.ARRAY,
-                    items=genai.types.Schema(
-                        type=genai.types.Type.OBJECT,
-                        required=[
-                            "question",
-                            "student_answer",
-                            "correct_answer",
-                            "correctness",
-                            "answer_written",
-                            "coordinates_of_answer",
-                        ],
-                        properties={
-                            "question": genai.types.Schema(
-                                type=genai.types.Type.STRING,
-                            ),
-                            "student_answer": genai.types.Schema(
-                                type=genai.types.Type.STRING,
-                            ),
-                            "correct_answer": genai.types.Schema(
-                                type=genai.types.Type.STRING,
-                            ),
-                            "correctness": genai.types.Schema(
-                                type=genai.types.Type.BOOLEAN,
-                            ),
-                            "answer_written": genai.types.Schema(
-                                type=genai.types.Type.BOOLEAN,
-                            ),
-                            "coordinates_of_answer": genai.types.Schema(
-                                type=genai.types.Type.OBJECT,
-                                required=["x_coordinate", "y_coordinate"],
-                                properties={
-                                    "x_coordinate": genai.types.Schema(
-                                        type=genai.types.Type.INTEGER,
-                                    ),
-                                    "y_coordinate": genai.types.Schema(
-                                        type=genai.types.Type.INTEGER,
-                                    ),
-                                },
-                            ),
-                        },
-                    ),
-                ),
-                "total_amount_of_questions": genai.types.Schema(
-                    type=genai.types.Type.INTEGER,
-                ),
-                "correct_answers": genai.types.Schema(
-                    type=genai.types.Type.INTEGER,
-                ),
-            },
-        ),
+
+def _elapsed_ms(start):
+    return round((time.perf_counter() - start) * 1000, 1)
+
+
+def _payload_bytes(contents):
+    return sum(
+        len(part.inline_data.data)
+        for content in contents
+        for part in content.parts
+        if part.inline_data is not None
     )
-    try:
+
+
+class _ModelStream:
+    """
+    One streamed grading request: the span, chunk counting and incremental
+    parsing shared by generate and generate_async, which only differ in how
+    they iterate over the stream.
+    """
+
+    def __init__(self, contents, on_question):
+        self.contents = contents
+        self.on_question = on_question
+        self.parser = QuestionStreamParser(RESPONSE_SCHEMA)
+        self.chunks = 0
+        self.failed = False
+        self._in_callback = False
+        self._span = None
+        self._start = None
+
+    @contextmanager
+    def request(self):
+        """
+        Wrap the request; a failed request is logged and marks the stream
+        failed. Errors raised by `on_question` are the caller's and propagate.
+        """
+        with span("model", payload_bytes=_payload_bytes(self.contents)) as model_span:
+            self._span = model_span
+            self._start = time.perf_counter()
+            try:
+                yield
+            except ResponseValidationError:
+                raise
+            except Exception as e:
+                if self._in_callback:
+                    raise
+                logger.error("Gemini request failed: %s", e)
+                model_span.set("error", type(e).__name__)
+                self.failed = True
+            finally:
+                model_span.set("chunks", self.chunks)
+                model_span.set("response_chars", len(self.parser.text))
+
+    def add(self, chunk):
+        if self.chunks == 0:
+            # Time to the first streamed chunk
+            self._span.set("ttfb_ms", _elapsed_ms(self._start))
+        self.chunks += 1
+        if not chunk.text:
+            return
+        logger.debug("Chunk: %s", chunk.text)
+        for question in self.parser.feed(chunk.text):
+            if self.on_question is not None:
+                self._in_callback = True
+                self.on_question(question)
+                self._in_callback = False
+
+    def result(self):
+        if self.failed or not self.parser.text:
+            return None
+        # Parse the streamed JSON directly and check it against the declared schema
+        return parse_response(self.parser.text)
+
+
+def _start_stream(image, prompt_text, mime_type, on_question):
+    # Returns None if the image can't be read
+    contents = _build_contents(image, prompt_text, mime_type)
+    if contents is None:
+        return None
+    return _ModelStream(contents, on_question)
+
+
+def generate(
+    image=None, prompt_text="", api_key=None, mime_type="image/png", on_question=None
+):
+    """
+    Grade an image with Gemini and return a validated GradingResult
+    (None if the request fails).
+
+    If `on_question` is given it is called with each Question as soon as that
+    entry is complete in the stream, before the rest of the response arrives.
+
+    `image` may be encoded image bytes (sent as-is with the given mime_type), a PIL
+    image (encoded to PNG in memory) or a file path.
+    """
+    client = client_manager.get(api_key)
+
+    stream = _start_stream(image, prompt_text, mime_type, on_question)
+    if stream is None:
+        return  # Exit if the image can't be read
+
+    with stream.request():
         for chunk in client.models.generate_content_stream(
-            model=model,
-            contents=contents,
-            config=generate_content_config,
+            model=MODEL,
+            contents=stream.contents,
+            config=GENERATE_CONTENT_CONFIG,
         ):
-            json_response += chunk.text
-            print(chunk.text, end="")  # Still print for debugging
+            stream.add(chunk)
+    return stream.result()
 
-        # Convert the JSON booleans (true/false) to Python booleans (True/False)
-        if json_response:
 
-            # Convert the parsed JSON to a Python-compatible string
-            # This will replace 'true' with 'True' and 'false' with 'False'
-            python_compatible_data = json_response.replace(
-                '"correctness": true', '"correctness": True'
-            )
-            python_compatible_data = python_compatible_data.replace(
-                '"correctness": false', '"correctness": False'
-            )
-            python_compatible_data = python_compatible_data.replace(
-                '"answer_written": true', '"answer_written": True'
-            )
-            python_compatible_data = python_compatible_data.replace(
-                '"answer_written": false', '"answer_written": False'
-            )
+async def generate_async(
+    image=None, prompt_text="", api_key=None, mime_type="image/png", on_question=None
+):
+    """
+    Async version of generate, sharing the same client and connection pool.
 
-            # Print a delimiter to separate the JSON output from the Python-compatible output
-            print("\n\n# Python-compatible data (for direct use):")
-            print(python_compatible_data)
+    Several gradings can run concurrently on one event loop, e.g. with
+    asyncio.gather.
+    """
+    client = client_manager.get(api_key)
 
-            return python_compatible_data
-    except Exception as e:
-        print(f"An error occurred: {e}")
+    stream = _start_stream(image, prompt_text, mime_type, on_question)
+    if stream is None:
+        return  # Exit if the image can't be read
+
+    with stream.request():
+        async for chunk in await client.aio.models.generate_content_stream(
+            model=MODEL,
+            contents=stream.contents,
+            config=GENERATE_CONTENT_CONFIG,
+        ):
+            stream.add(chunk)
+    return stream.result()
@@ -1,12 +1,28 @@
-from PIL import Image, ImageDraw, ImageFont
-import sys
+import logging
+from functools import lru_cache
+from PIL import Image, ImageDraw
+from fonts import get_font, stamp_text
+from results import GradingResult
+from tracing import span
+from utils import load_image
 
+logger = logging.getLogger(__name__)
 
 # Mark settings
 MARK_OFFSET_X = 35  # How many pixels to the left of the coordinate to place the mark
 MARK_SIZE = 40  # Size reference for all marks (both checkmark and X)
 MARK_THICKNESS = max(3, MARK_SIZE // 8)  # Thickness for lines
 
+# Mark rendering methods:
+#   "draw"   - draw every mark with ImageDraw.line (original behaviour)
+#   "sprite" - stamp cached anti-aliased mark sprites with paste
+# Both take under 10 ms for 500 marks (see benchmarks/bench_marks.py) and
+# neither is consistently faster, so the default stays with line drawing;
+# sprites trade a little speed on tall sheets for anti-aliased edges.
+DEFAULT_MARK_METHOD = "draw"
+# Sprites are drawn this many times larger, then downsampled for anti-aliasing
+SPRITE_SUPERSAMPLE = 4
+
 
 def draw_checkmark(draw, position, size, color, thickness):
     """Draws a checkmark using lines."""
@@ -19,7 +35,9 @@ def draw_checkmark(draw, position, size, color, thickness):
     # Draw the two lines of the checkmark
     draw.line([p1, p2], fill=color, width=thickness, joint="curve")
     draw.line([p2, p3], fill=color, width=thickness, joint="curve")
-    print(f"Drawing checkmark lines in {color} near ({position[0]}, {position[1]})")
+    logger.debug(
+        "Drawing checkmark lines in %s near (%s, %s)", color, position[0], position[1]
+    )
 
 
 def draw_x_mark(draw, position, size, color, thickness):
@@ -35,179 +53,291 @@ def draw_x_mark(draw, position, size, color, thickness):
     # Draw the two diagonal lines of the X
     draw.line([top_left, bottom_right], fill=color, width=thickness, joint="curve")
     draw.line([top_right, bottom_left], fill=color, width=thickness, joint="curve")
-    print(f"Drawing X-mark lines in {color} near ({position[0]}, {position[1]})")
+    logger.debug(
+        "Drawing X-mark lines in %s near (%s, %s)", color, position[0], position[1]
+    )
+
+
+def mark_for_question(question):
+    """Mark data for one question, or None if no answer was written."""
+    # Skip questions that don't have an answer written
+    if not question.answer_written:
+        return None
+
+    coords = question.coords
+
+    # Create mark data
+    if question.correctness:
+        # Correct answer
+        return {
+            "coords": coords,
+            "type": "check",
+            "color": "green",
+            "is_correct": True,
+        }
+    else:
+        # Incorrect answer
+        return {
+            "coords": coords,
+            "type": "x_mark",
+            "color": "red",
+            "is_correct": False,
+        }
 
 
 def generate_marks_data(data):
+    # `data` is a validated GradingResult, so every question has coordinates
     marks_data = []
 
     # Process each question to create mark data
-    for i, question in enumerate(data["questions"]):
-        # Skip questions that are missing required fields or don't have an answer written
-        if not question.get("answer_written", False):
-            continue
+    for question in data.questions:
+        mark = mark_for_question(question)
+        if mark is not None:
+            marks_data.append(mark)
+
+    return marks_data
+
+
+def mark_position(mark_info):
+    """Top-left corner of a mark's MARK_SIZE box, next to its answer."""
+    x, y = mark_info["coords"]
+
+    # Calculate the top-left position for the mark (offset to the left)
+    mark_x = x - MARK_OFFSET_X
+
+    if mark_info["type"] == "check":
+        # Adjust y slightly down to better align visually
+        return mark_x, y + 5
+    # Adjust y position to center the X mark
+    return mark_x, y - MARK_SIZE // 3
+
+
+def draw_mark(draw, mark_info):
+    """Draw a single check or X mark next to its answer coordinates."""
+    x, y = mark_info["coords"]
+    color = mark_info["color"]
+    mark_type = mark_info["type"]
+    mark_x, mark_y = mark_position(mark_info)
+
+    if mark_type == "check":
+        # Draw checkmark using lines
+        draw_checkmark(draw, (mark_x, mark_y), MARK_SIZE, color, MARK_THICKNESS)
+    elif mark_type == "x_mark":
+        # Draw X mark using lines
+        draw_x_mark(draw, (mark_x, mark_y), MARK_SIZE, color, MARK_THICKNESS)
+        # X marks are for incorrect answers
+        logger.debug(
+            "Drawing X mark in %s for Incorrect answer near (%s, %s) at (%s, %s)",
+            color,
+            x,
+            y,
+            mark_x,
+            mark_y,
+        )
+    else:
+        logger.warning("Unknown mark type '%s' near (%s,%s).", mark_type, x, y)
+
+
+@lru_cache(maxsize=64)
+def render_mark(mark_type, color, size=MARK_SIZE, thickness=MARK_THICKNESS):
+    """
+    Rasterise a mark once per type, colour and size (the mark sprites).
+
+    The mark is drawn with the same lines as draw_checkmark / draw_x_mark at
+    SPRITE_SUPERSAMPLE times the size and box-downsampled, which anti-aliases it.
+
+    Returns:
+        tuple: (solid RGB image, "L" coverage mask, (dx, dy) offset of both
+            from the top-left of the mark's box); trimmed to the inked area and
+            shared between callers, so never modify them
+    """
+    scale = SPRITE_SUPERSAMPLE
+    large = Image.new("L", (size * scale, size * scale), 0)
+    draw = ImageDraw.Draw(large)
+    if mark_type == "check":
+        draw_checkmark(draw, (0, 0), size * scale, 255, thickness * scale)
+    elif mark_type == "x_mark":
+        draw_x_mark(draw, (0, 0), size * scale, 255, thickness * scale)
+    else:
+        raise ValueError(f"Unknown mark type '{mark_type}'")
+    mask = large.resize((size, size), Image.BOX)
+    # Pasting costs per pixel, so the transparent border is cut off
+    left, top, right, bottom = mask.getbbox()
+    mask = mask.crop((left, top, right, bottom))
+    return Image.new("RGB", mask.size, color), mask, (left, top)
 
-        # Get coordinates from the question data if available
-        if "coordinates_of_answer" in question:
-            coords = (
-                question["coordinates_of_answer"]["x_coordinate"],
-                question["coordinates_of_answer"]["y_coordinate"],
-            )
-        else:
-            print(f"Warning: Question {i+1} is missing coordinates - skipping")
+
+def stamp_marks(image, marks_data):
+    """
+    Stamp every mark onto the image in one pass, from the cached sprites.
+
+    Each mark is a single paste through its coverage mask (clipped at the edges
+    of the sheet); there is no per-mark drawing or logging, so sheets with
+    hundreds of marks stay cheap.
+    """
+    paste = image.paste
+    for mark_info in marks_data:
+        mark_type = mark_info["type"]
+        if mark_type not in ("check", "x_mark"):
+            x, y = mark_info["coords"]
+            logger.warning("Unknown mark type '%s' near (%s,%s).", mark_type, x, y)
             continue
+        sprite, mask, (dx, dy) = render_mark(mark_type, mark_info["color"])
+        x, y = mark_position(mark_info)
+        paste(sprite, (round(x) + dx, round(y) + dy), mask)
+    logger.debug("Stamped %d mark sprites", len(marks_data))
 
-        # Create mark data
-        if question["correctness"]:
-            # Correct answer
-            mark = {
-                "coords": coords,
-                "type": "check",
-                "color": "green",
-                "is_correct": True,
-            }
-        else:
-            # Incorrect answer
-            mark = {
-                "coords": coords,
-                "type": "x_mark",
-                "color": "red",
-                "is_correct": False,
-            }
 
-        marks_data.append(mark)
+def render_marks(image, marks_data, method=DEFAULT_MARK_METHOD):
+    """Put the marks onto the image in place with the given method."""
+    if method == "sprite":
+        stamp_marks(image, marks_data)
+    else:
+        draw = ImageDraw.Draw(image)
+        for mark_info in marks_data:
+            draw_mark(draw, mark_info)
 
-    return marks_data
+
+class ProgressiveGrader:
+    """
+    Draws marks onto a copy of the sheet as questions arrive from the stream,
+    so partial results can be shown before the model has finished.
+    """
+
+    def __init__(self, image, method=DEFAULT_MARK_METHOD):
+        self.image = load_image(image).convert("RGB")
+        self.method = method
+        self.questions = []
+
+    @property
+    def correct_count(self):
+        return sum(1 for q in self.questions if q.correctness)
+
+    def add(self, question):
+        self.questions.append(question)
+        mark = mark_for_question(question)
+        if mark is not None:
+            render_marks(self.image, [mark], self.method)
 
 
 # --- Main Script ---
-def grade(INPUT_IMAGE_FILENAME, data=None, output_path=None):
+def grade(image, data=None, output_path=None, method=DEFAULT_MARK_METHOD):
+    # `image` may be a PIL image, encoded bytes or a file path. The graded image is
+    # returned in the result and only written to disk when an output_path is given.
+    # `method` is "sprite" (cached mark sprites) or "draw" (line drawing).
     if data is None:
-        print("No data provided. Using default test data.")
+        logger.info("No data provided. Using default test data.")
         # Define default test data here if needed
-        data = {
-            "correct_answers": 1,
-            "questions": [
-                {
-                    "answer_written": True,
-                    "correctness": True,
-                    "question": "14x83",
-                    "student_answer": "1162",
-                    "correct_answer": "1162",
-                    "coordinates_of_answer": {"x_coordinate": 69, "y_coordinate": 156},
-                },
-                {
-                    "answer_written": True,
-                    "correctness": False,
-                    "question": "93x65",
-                    "student_answer": "21",
-                    "correct_answer": "6045",
-                    "coordinates_of_answer": {"x_coordinate": 229, "y_coordinate": 158},
-                },
-            ],
-            "total_amount_of_questions": 2,
-        }
+        data = GradingResult.from_dict(
+            {
+                "correct_answers": 1,
+                "questions": [
+                    {
+                        "answer_written": True,
+                        "correctness": True,
+                        "question": "14x83",
+                        "student_answer": "1162",
+                        "correct_answer": "1162",
+                        "coordinates_of_answer": {
+                            "x_coordinate": 69,
+                            "y_coordinate": 156,
+                        },
+                    },
+                    {
+                        "answer_written": True,
+                        "correctness": False,
+                        "question": "93x65",
+                        "student_answer": "21",
+                        "correct_answer": "6045",
+                        "coordinates_of_answer": {
+                            "x_coordinate": 229,
+                            "y_coordinate": 158,
+                        },
+                    },
+                ],
+                "total_amount_of_questions": 2,
+            }
+        )
 
     # Generate marks data based on the questions
     marks_data = generate_marks_data(data)
 
     # Log summary of marking
-    print(
-        f"Marking {len(marks_data)} answers out of {data['total_amount_of_questions']} total questions"
+    logger.info(
+        "Marking %d answers out of %d total questions",
+        len(marks_data),
+        data.total_amount_of_questions,
     )
-    print(f"Student got {data['correct_answers']} correct answers")
+    logger.info("Student got %d correct answers", data.correct_answers)
+
+    if method not in ("sprite", "draw"):
+        raise ValueError(f"Unknown mark method '{method}'")
 
     try:
-        img = Image.open(INPUT_IMAGE_FILENAME).convert("RGB")
-        print(f"Successfully loaded image: {INPUT_IMAGE_FILENAME}")
+        img = load_image(image)
+        # Marks are drawn on a copy; convert() already makes one when needed
+        img = img.copy() if img.mode == "RGB" else img.convert("RGB")
+        logger.debug("Successfully loaded image: %s", img.size)
     except FileNotFoundError:
-        print(f"Error: Input image '{INPUT_IMAGE_FILENAME}' not found.")
-        print("Please make sure the image file is in the same directory as the script.")
-        sys.exit(1)
+        logger.error("Input image '%s' not found.", image)
+        raise
     except Exception as e:
-        print(f"Error loading image: {e}")
-        sys.exit(1)
+        logger.error("Error loading image: %s", e)
+        raise
 
     draw = ImageDraw.Draw(img)
-    print("No fonts needed - all marks will be drawn using lines.")
 
     # Draw each mark based on its type
-    for mark_info in marks_data:
-        x, y = mark_info["coords"]
-        color = mark_info["color"]
-        mark_type = mark_info["type"]
-
-        # Calculate the top-left position for the mark (offset to the left)
-        mark_x = x - MARK_OFFSET_X
-
-        if mark_type == "check":
-            # Adjust y slightly down to better align visually
-            mark_y = y + 5
-            # Draw checkmark using lines
-            draw_checkmark(draw, (mark_x, mark_y), MARK_SIZE, color, MARK_THICKNESS)
-        elif mark_type == "x_mark":
-            # Adjust y position to center the X mark
-            mark_y = y - MARK_SIZE // 3
-            # Draw X mark using lines
-            draw_x_mark(draw, (mark_x, mark_y), MARK_SIZE, color, MARK_THICKNESS)
-            status = "Incorrect"  # X marks are for incorrect answers
-            print(
-                f"Drawing X mark in {color} for {status} answer near ({x}, {y}) at ({mark_x}, {mark_y})"
-            )
-        else:
-            print(f"Warning: Unknown mark type '{mark_type}' near ({x},{y}).")
+    with span(
+        "render",
+        width=img.width,
+        height=img.height,
+        marks=len(marks_data),
+        method=method,
+    ):
+        render_marks(img, marks_data, method)
 
     # Add a grade score at the top right of the image
-    correct_count = sum(
-        1 for q in data["questions"] if q.get("correctness", False) == True
-    )
-    grade_text = f"Score: {correct_count}/{data['total_amount_of_questions']}"
+    correct_count = sum(1 for q in data.questions if q.correctness)
+    grade_text = f"Score: {correct_count}/{data.total_amount_of_questions}"
     # Font size for the grade text - adjust this value to change text size
     GRADE_FONT_SIZE = 20
 
     try:
-        try:
-            font = ImageFont.truetype("arial.ttf", GRADE_FONT_SIZE)
-        except:
-            font = ImageFont.load_default()
-        try:
-            # First try the newer method
-            bbox = font.getbbox(grade_text)
-            text_width = bbox[2] - bbox[0]
-            text_height = bbox[3] - bbox[1]
-        except AttributeError:
-            try:
-                # Fall back to textbbox if available (Pillow >=8.0.0)
-                left, top, right, bottom = draw.textbbox((0, 0), grade_text, font=font)
-                text_width = right - left
-                text_height = bottom - top
-            except AttributeError:
-                # Last resort for very old Pillow versions
-                text_width, text_height = draw.textsize(grade_text, font=font)
+        font = get_font(GRADE_FONT_SIZE)
+        bbox = font.getbbox(grade_text)
+        text_width = bbox[2] - bbox[0]
 
         # Position the text in the top right with 20px padding
         text_position = (img.width - text_width - 20, 10)
 
-        # Draw the grade text at the top right of the image
-        draw.text(text_position, grade_text, fill="blue", font=font)
-        print(f"Added grade text: {grade_text} at position {text_position}")
+        # Stamp the grade text from the label atlas at the top right of the image
+        stamp_text(img, text_position, grade_text, GRADE_FONT_SIZE, "blue")
+        logger.debug("Added grade text: %s at position %s", grade_text, text_position)
     except Exception as e:
-        print(f"Could not add grade text: {e}")
+        logger.warning("Could not add grade text: %s", e)
         # Fallback to a fixed position if all else fails
-        draw.text((img.width - 200, 20), grade_text, fill="blue", font=font)
-        print(f"Fallback: Added grade text at fixed position")
+        draw.text(
+            (img.width - 200, 20),
+            grade_text,
+            fill="blue",
+            font=get_font(GRADE_FONT_SIZE),
+        )
+        logger.debug("Fallback: Added grade text at fixed position")
 
-    # Save the modified image
-    try:
-        img.save(output_path)
-        print(f"\nSuccessfully saved graded image as: {output_path}")
-    except Exception as e:
-        print(f"Error saving image: {e}")
+    # Save the modified image if requested
+    if output_path:
+        try:
+            img.save(output_path)
+            logger.info("Successfully saved graded image as: %s", output_path)
+        except Exception as e:
+            logger.error("Error saving image: %s", e)
 
     return {
         "success": True,
+        "image": img,
         "output_file": output_path,
         "marked_answers": len(marks_data),
-        "total_questions": data["total_amount_of_questions"],
-        "correct_answers": data["correct_answers"],
+        "total_questions": data.total_amount_of_questions,
+        "correct_answers": data.correct_answers,
     }
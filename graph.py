@@ -1,57 +1,179 @@
-from PIL import Image, ImageDraw, ImageFont
+import logging
+from functools import lru_cache
+import numpy as np
+from PIL import Image, ImageDraw
+from fonts import get_font, stamp_text
+from utils import load_image
+
+logger = logging.getLogger(__name__)
+
+GRID_FONT_COLOR = (255, 0, 0, 180)  # Red font with slight transparency
+
+# Overlay methods:
+#   "numpy" - blend grid lines into the pixel array and stamp cached label strips
+#   "layer" - alpha-composite a full-size overlay tiled from cached strips
+#   "draw"  - draw every line and label on a fresh overlay (original behaviour)
+DEFAULT_METHOD = "numpy"
 
 
 def overlay_grid_on_image(
-    image_path,
+    image,
     grid_spacing=50,
     grid_opacity=50,
     label_inset=10,
     label_font_size=14,
-    output_path="grid_overlay.png",
+    output_path=None,
+    method=DEFAULT_METHOD,
 ):
 
     # Overlays a grid with pixel counts onto an existing image.
+    # `image` may be a PIL image, encoded bytes or a file path. The combined image
+    # is returned and only written to disk when an output_path is given.
 
     try:
         # Open the existing image
-        img = Image.open(image_path).convert("RGBA")
-        width, height = img.size
-
-        # Create a transparent overlay image for the grid
-        overlay = Image.new(
-            "RGBA", (width, height), (0, 0, 0, 0)
-        )  # Transparent background
-        draw = ImageDraw.Draw(overlay)
-
-        grid_color = (0, 0, 0, grid_opacity)  # Black grid with specified opacity
-        grid_font_color = (255, 0, 0, 180)  # Red font with slight transparency
-
-        try:
-            grid_font = ImageFont.truetype("arial.ttf", label_font_size)
-        except IOError:
-            grid_font = ImageFont.load_default()
-
-        # Draw vertical grid lines and pixel labels
-        for x in range(0, width, grid_spacing):
-            draw.line([(x, 0), (x, height)], fill=grid_color, width=1)
-            draw.text(
-                (x + 2, label_inset), str(x), fill=grid_font_color, font=grid_font
-            )  # Label on top
-
-        # Draw horizontal grid lines and pixel labels
-        for y in range(0, height, grid_spacing):
-            draw.line([(0, y), (width, y)], fill=grid_color, width=1)
-            draw.text(
-                (label_inset, y + 2), str(y), fill=grid_font_color, font=grid_font
-            )  # Label on left
-
-        combined = Image.alpha_composite(img, overlay).convert("RGB")
-
-        # Save the combined image
-        combined.save(output_path)
-        print(f"Grid overlay image saved to {output_path}")
+        img = load_image(image)
+
+        if method == "numpy":
+            combined = _overlay_numpy(
+                img, grid_spacing, grid_opacity, label_inset, label_font_size
+            )
+        elif method == "layer":
+            combined = _overlay_layer(
+                img, grid_spacing, grid_opacity, label_inset, label_font_size
+            )
+        elif method == "draw":
+            combined = _overlay_draw(
+                img, grid_spacing, grid_opacity, label_inset, label_font_size
+            )
+        else:
+            raise ValueError(f"Unknown overlay method '{method}'")
+
+        # Save the combined image if requested
+        if output_path:
+            combined.save(output_path)
+            logger.info("Grid overlay image saved to %s", output_path)
+
+        return combined
 
     except FileNotFoundError:
-        print(f"Error: Image not found at {image_path}")
+        logger.error("Image not found at %s", image)
     except Exception as e:
-        print(f"An error occurred: {e}")
+        logger.error("Could not add the grid overlay: %s", e)
+
+
+def _draw_labels(draw, width, height, grid_spacing, label_inset, font):
+    # Label on top for every vertical line, on the left for every horizontal line
+    for x in range(0, width, grid_spacing):
+        draw.text((x + 2, label_inset), str(x), fill=GRID_FONT_COLOR, font=font)
+    for y in range(0, height, grid_spacing):
+        draw.text((label_inset, y + 2), str(y), fill=GRID_FONT_COLOR, font=font)
+
+
+def _overlay_draw(img, grid_spacing, grid_opacity, label_inset, label_font_size):
+    img = img.convert("RGBA")
+    width, height = img.size
+
+    # Create a transparent overlay image for the grid
+    overlay = Image.new("RGBA", (width, height), (0, 0, 0, 0))  # Transparent background
+    draw = ImageDraw.Draw(overlay)
+
+    grid_color = (0, 0, 0, grid_opacity)  # Black grid with specified opacity
+    grid_font = get_font(label_font_size)
+
+    # Draw vertical grid lines
+    for x in range(0, width, grid_spacing):
+        draw.line([(x, 0), (x, height)], fill=grid_color, width=1)
+
+    # Draw horizontal grid lines
+    for y in range(0, height, grid_spacing):
+        draw.line([(0, y), (width, y)], fill=grid_color, width=1)
+
+    _draw_labels(draw, width, height, grid_spacing, label_inset, grid_font)
+
+    return Image.alpha_composite(img, overlay).convert("RGB")
+
+
+@lru_cache(maxsize=8)
+def _grid_tile_strip(width, grid_spacing, grid_opacity):
+    """One grid row (horizontal line on top, vertical lines below) for tiling."""
+    strip = Image.new("RGBA", (width, grid_spacing), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(strip)
+    grid_color = (0, 0, 0, grid_opacity)
+    for x in range(0, width, grid_spacing):
+        draw.line([(x, 0), (x, grid_spacing)], fill=grid_color, width=1)
+    draw.line([(0, 0), (width, 0)], fill=grid_color, width=1)
+    return strip
+
+
+def _grid_layer(
+    width, height, grid_spacing, grid_opacity, label_inset, label_font_size
+):
+    """
+    Full-size overlay (lines and labels), tiled from the cached strip and label
+    strips. The layer itself is built per call: a full-size RGBA layer is tens
+    of MB on tall sheets, too much to keep around per sheet size.
+    """
+    layer = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    strip = _grid_tile_strip(width, grid_spacing, grid_opacity)
+    for top in range(0, height, grid_spacing):
+        layer.paste(strip, (0, top))
+    top, left = _label_strips(width, height, grid_spacing, label_inset, label_font_size)
+    layer.alpha_composite(top)
+    layer.alpha_composite(left)
+    return layer
+
+
+def _overlay_layer(img, grid_spacing, grid_opacity, label_inset, label_font_size):
+    layer = _grid_layer(
+        img.width, img.height, grid_spacing, grid_opacity, label_inset, label_font_size
+    )
+    return Image.alpha_composite(img.convert("RGBA"), layer).convert("RGB")
+
+
+@lru_cache(maxsize=16)
+def _label_strips(width, height, grid_spacing, label_inset, label_font_size):
+    """
+    The labels only ever cover a band along the top and a band along the left
+    edge, so they are cached as two small RGBA strips instead of a full overlay.
+
+    Returns:
+        tuple: (top_strip, left_strip)
+    """
+    font = get_font(label_font_size)
+    text_height = font.getbbox("0123456789")[3]
+    widest_label = str((height - 1) // grid_spacing * grid_spacing)
+    text_width = int(font.getlength(widest_label)) + 1
+
+    # Labels are stamped from the cached label atlas rather than drawn again
+    top = Image.new("RGBA", (width, label_inset + text_height + 1), (0, 0, 0, 0))
+    for x in range(0, width, grid_spacing):
+        stamp_text(top, (x + 2, label_inset), str(x), label_font_size, GRID_FONT_COLOR)
+
+    left = Image.new("RGBA", (label_inset + text_width + 1, height), (0, 0, 0, 0))
+    for y in range(0, height, grid_spacing):
+        stamp_text(left, (label_inset, y + 2), str(y), label_font_size, GRID_FONT_COLOR)
+
+    return top, left
+
+
+def _overlay_numpy(img, grid_spacing, grid_opacity, label_inset, label_font_size):
+    pixels = np.array(img.convert("RGB"))
+    height, width = pixels.shape[:2]
+
+    # Blending black at alpha a over a pixel scales it by (255 - a) / 255.
+    # Rows are blended first; columns skip those rows so crossings are only
+    # darkened once, exactly like a single overlay.
+    keep = np.uint16(255 - grid_opacity)
+    rows = pixels[::grid_spacing]
+    pixels[::grid_spacing] = (rows * keep + 127) // 255
+    other_rows = np.ones(height, dtype=bool)
+    other_rows[::grid_spacing] = False
+    columns = pixels[other_rows, ::grid_spacing]
+    pixels[other_rows, ::grid_spacing] = (columns * keep + 127) // 255
+
+    combined = Image.fromarray(pixels)
+    top, left = _label_strips(width, height, grid_spacing, label_inset, label_font_size)
+    combined.paste(top, (0, 0), top)
+    combined.paste(left, (0, 0), left)
+    return combined
@@ -0,0 +1,293 @@
+import io
+import logging
+import math
+import time
+from dataclasses import dataclass
+
+from PIL import Image
+
+from grade import grade
+from results import DocumentResult
+from tiling import run_sheet
+from tracing import set_attribute, span
+from utils import (
+    apply_orientation,
+    fix_image_orientation,
+    image_to_bytes,
+    load_image,
+    read_orientation,
+    resize_image_width,
+)
+
+logger = logging.getLogger(__name__)
+
+# File types accepted for a submission
+SUBMISSION_TYPES = ["jpg", "jpeg", "png", "pdf", "tif", "tiff"]
+
+# Pages are brought to this width, the same as single uploaded images
+PAGE_WIDTH = 1024
+# JPEGs may be decoded this much below the target width (then upscaled the
+# last few percent) so draft mode can pick the next smaller DCT scale
+DRAFT_TOLERANCE = 0.9
+# JPEG quality of the pages in the graded PDF
+GRADED_PAGE_QUALITY = 85
+
+
+def is_pdf(source):
+    """True if `source` (bytes or a path) is a PDF; reads only the header."""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        header = bytes(source[:5])
+    else:
+        with open(source, "rb") as f:
+            header = f.read(5)
+    return header == b"%PDF-"
+
+
+def _open_pdf(source):
+    # Imported on first use so single-image grading never loads PDFium
+    import pypdfium2 as pdfium
+
+    return pdfium.PdfDocument(source)
+
+
+def count_pages(source):
+    """Number of pages (PDF) or frames (TIFF) in a submission; 1 for images."""
+    if is_pdf(source):
+        pdf = _open_pdf(source)
+        try:
+            return len(pdf)
+        finally:
+            pdf.close()
+    with load_image(source) as img:
+        return getattr(img, "n_frames", 1)
+
+
+def iter_pages(source, page_width=PAGE_WIDTH):
+    """
+    Yield the pages of a submission one at a time as PIL images.
+
+    PDF pages are rasterised straight at `page_width` (only the current page is
+    rendered), TIFF frames are decoded on demand and plain images are yielded
+    once. Files given by path are read by the decoder as needed rather than up
+    front, and only one decoded page is held at a time.
+
+    Args:
+        source: Encoded bytes or path of a PDF, TIFF, JPEG or PNG
+    """
+    if is_pdf(source):
+        pdf = _open_pdf(source)
+        try:
+            for index in range(len(pdf)):
+                page = pdf[index]
+                try:
+                    scale = page_width / page.get_width()
+                    yield page.render(scale=scale).to_pil()
+                finally:
+                    page.close()
+        finally:
+            pdf.close()
+        return
+
+    with load_image(source) as img:
+        for index in range(getattr(img, "n_frames", 1)):
+            img.seek(index)
+            # copy() decodes just this frame and detaches it from the file
+            yield img.copy()
+
+
+def prepare_page(image, page_width=PAGE_WIDTH):
+    """Fix orientation and resize a page, the same way the upload step does."""
+    image = fix_image_orientation(image)
+    if image.width != page_width:
+        image = resize_image_width(image, target_width=page_width)
+    return image.convert("RGB")
+
+
+@dataclass(frozen=True)
+class DecodedUpload:
+    """
+    An uploaded photo decoded straight to the working width.
+
+    `peak_bytes` is the most bitmap memory held at once while decoding (the
+    decoded image plus the copy being made from it).
+    """
+
+    image: Image.Image
+    orientation: int
+    source_size: tuple
+    decoded_size: tuple
+    decode_ms: float
+    peak_bytes: int
+
+    def describe(self):
+        """Summary of the decode (for traces and logs)."""
+        return {
+            "source_size": "x".join(map(str, self.source_size)),
+            "decoded_size": "x".join(map(str, self.decoded_size)),
+            "orientation": self.orientation,
+            "decode_ms": round(self.decode_ms, 1),
+            "decode_peak_kb": self.peak_bytes // 1024,
+        }
+
+
+def _bitmap_bytes(image):
+    return image.width * image.height * len(image.getbands())
+
+
+def decode_upload(source, target_width=PAGE_WIDTH):
+    """
+    Decode an uploaded image at (close to) `target_width`, upright.
+
+    Only the EXIF orientation tag is read. JPEGs are decoded in draft mode,
+    where the decoder scales by 1/2, 1/4 or 1/8 while decoding, so a 12 MP
+    phone photo never exists in memory at full size; other formats are shrunk
+    with reduce() right after decoding. Orientation and the final resize are
+    applied to the small image, which ends up the same size and way up as with
+    fix_image_orientation and resize_image_width(target_width).
+
+    Args:
+        source: Encoded bytes, path or PIL image of a single-page upload
+
+    Returns:
+        DecodedUpload: The image and how long / how much memory decoding took
+    """
+    start = time.perf_counter()
+    with span("decode") as decode_span:
+        img = load_image(source)
+        orientation = read_orientation(img)
+        source_size = img.size
+
+        # Orientations 5-8 are stored sideways: the upright width is the height
+        sideways = orientation in (5, 6, 7, 8)
+        upright_width = img.height if sideways else img.width
+        scale = min(1.0, target_width * DRAFT_TOLERANCE / upright_width)
+        if img.format == "JPEG" and scale < 1.0:
+            img.draft(
+                "RGB", (math.ceil(img.width * scale), math.ceil(img.height * scale))
+            )
+        img.load()
+        decoded_size = img.size
+        peak = _bitmap_bytes(img)
+
+        factor = (img.height if sideways else img.width) // target_width
+        # Palette and bilevel images can't be reduced (resize is nearest for them)
+        if factor >= 2 and img.mode not in ("1", "P"):
+            reduced = img.reduce(factor)
+            peak = max(peak, _bitmap_bytes(img) + _bitmap_bytes(reduced))
+            img = reduced
+
+        if orientation != 1:
+            upright = apply_orientation(img, orientation)
+            peak = max(peak, _bitmap_bytes(img) + _bitmap_bytes(upright))
+            img = upright
+
+        if img.width != target_width:
+            resized = resize_image_width(img, target_width=target_width)
+            peak = max(peak, _bitmap_bytes(img) + _bitmap_bytes(resized))
+            img = resized
+
+        decoded = DecodedUpload(
+            image=img,
+            orientation=orientation,
+            source_size=source_size,
+            decoded_size=decoded_size,
+            decode_ms=(time.perf_counter() - start) * 1000,
+            peak_bytes=peak,
+        )
+        for key, value in decoded.describe().items():
+            decode_span.set(key, value)
+        # Decode time and memory also go on the request trace
+        set_attribute("decode_ms", round(decoded.decode_ms, 1))
+        set_attribute("decode_peak_kb", decoded.peak_bytes // 1024)
+    logger.info("Decoded upload: %s", decoded.describe())
+    return decoded
+
+
+class GradedDocument:
+    """
+    Multi-page graded output, written page by page.
+
+    Each page is kept as a JPEG inside the PDF being built, so finished pages
+    don't stay in memory as bitmaps.
+    """
+
+    def __init__(self, quality=GRADED_PAGE_QUALITY):
+        import pypdfium2 as pdfium
+
+        self._pdfium = pdfium
+        self._pdf = pdfium.PdfDocument.new()
+        self.quality = quality
+        self.page_count = 0
+
+    def add_page(self, image):
+        # Pages are sized at 72 dpi, so one image pixel is one PDF point
+        width, height = image.size
+        page = self._pdf.new_page(width, height)
+        pdf_image = self._pdfium.PdfImage.new(self._pdf)
+        pdf_image.load_jpeg(
+            io.BytesIO(image_to_bytes(image, format="JPEG", quality=self.quality)),
+            inline=True,
+        )
+        pdf_image.set_matrix(self._pdfium.PdfMatrix().scale(width, height))
+        page.insert_obj(pdf_image)
+        page.gen_content()
+        page.close()
+        self.page_count += 1
+
+    def to_bytes(self):
+        buffer = io.BytesIO()
+        self._pdf.save(buffer)
+        return buffer.getvalue()
+
+    def close(self):
+        self._pdf.close()
+
+
+def grade_document(source, api_key, on_page=None, on_question=None):
+    """
+    Grade every page of a submission, one page at a time.
+
+    Each page goes through orientation, resize, grid, model and grading before
+    the next one is decoded; graded pages are appended to a multi-page PDF.
+
+    Args:
+        source: Encoded bytes or path of the submission
+        api_key (str): Gemini API key
+        on_page: Called as on_page(page_number, page_count, graded_image,
+            result) after each page is graded
+        on_question: Called as on_question(page_number, question) while a page
+            streams in
+
+    Returns:
+        tuple: (DocumentResult, graded PDF bytes)
+    """
+    page_count = count_pages(source)
+    document = GradedDocument()
+    page_results = []
+    try:
+        for number, page in enumerate(iter_pages(source), start=1):
+            with span("page", number=number, of=page_count):
+                image = prepare_page(page)
+
+                page_question = None
+                if on_question is not None:
+
+                    def page_question(question, number=number):
+                        on_question(number, question)
+
+                result = run_sheet(image, api_key=api_key, on_question=page_question)
+                graded = grade(image, data=result)["image"]
+                document.add_page(graded)
+                page_results.append(result)
+                logger.info(
+                    "Graded page %d of %d: %d/%d",
+                    number,
+                    page_count,
+                    result.correct_answers,
+                    result.total_amount_of_questions,
+                )
+            if on_page is not None:
+                on_page(number, page_count, graded, result)
+        return DocumentResult(pages=tuple(page_results)), document.to_bytes()
+    finally:
+        document.close()
@@ -0,0 +1,172 @@
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+JOB_SETTINGS = {
+    "max_workers": 8,  # Gradings run at the same time per server
+    "keep_seconds": 15 * 60,  # Finished jobs nobody picked up are dropped after this
+}
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class Job:
+    """
+    One grading running (or waiting to run) on the worker pool.
+
+    The job function reports progress by publishing events (e.g. streamed
+    questions); the page that submitted it reads them back by index on each poll.
+    """
+
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.status = QUEUED
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        # Set when the job is cancelled while running; its result is unwanted
+        self.cancelled = False
+        self._future = None
+        self._events = []
+        self._lock = threading.Lock()
+
+    @property
+    def done(self):
+        return self.status in (DONE, FAILED, CANCELLED)
+
+    @property
+    def elapsed(self):
+        """Seconds since submission (until finished)."""
+        end = self.finished_at if self.finished_at is not None else time.time()
+        return end - self.submitted_at
+
+    def publish(self, event):
+        with self._lock:
+            self._events.append(event)
+
+    def events_since(self, index):
+        """
+        Returns:
+            list: Events published after the first `index` ones
+        """
+        with self._lock:
+            return self._events[index:]
+
+
+class JobQueue:
+    """
+    Thread pool that runs gradings off the Streamlit script thread.
+
+    Jobs are looked up by ID, so a page can poll for its result across reruns
+    and pick it up once done.
+    """
+
+    def __init__(self, max_workers=None, keep_seconds=None):
+        self.keep_seconds = keep_seconds or JOB_SETTINGS["keep_seconds"]
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers or JOB_SETTINGS["max_workers"],
+            thread_name_prefix="grading",
+        )
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, name, func, *args, **kwargs):
+        """
+        Queue `func(job, *args, **kwargs)`; its return value becomes the job's
+        result and an exception marks the job failed.
+
+        Returns:
+            str: The job ID
+        """
+        self._prune()
+        job = Job(name)
+        with self._lock:
+            self._jobs[job.id] = job
+        job._future = self._executor.submit(self._run, job, func, args, kwargs)
+        logger.info("Queued %s job %s", name, job.id[:8])
+        return job.id
+
+    def _run(self, job, func, args, kwargs):
+        job.started_at = time.time()
+        job.status = RUNNING
+        try:
+            job.result = func(job, *args, **kwargs)
+            status = DONE
+        # Anything that escapes (even SystemExit) must still finish the job, or
+        # the page would poll it forever
+        except BaseException as e:
+            job.error = e
+            status = FAILED
+            logger.warning("%s job %s failed: %s", job.name, job.id[:8], e)
+        # Finished before it is marked done, so done jobs always have a finish time
+        job.finished_at = time.time()
+        job.status = status
+        logger.info(
+            "%s job %s %s after %.1f s", job.name, job.id[:8], job.status, job.elapsed
+        )
+
+    def get(self, job_id):
+        """Return the job, or None if it is unknown or was dropped."""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def pop(self, job_id):
+        """Remove a job once its result has been picked up."""
+        with self._lock:
+            return self._jobs.pop(job_id, None)
+
+    def cancel(self, job_id):
+        """
+        Drop a job whose result is no longer wanted. A queued job never runs; a
+        running one can't be interrupted, so it finishes with `cancelled` set
+        and its result is discarded.
+
+        Returns:
+            Job: The cancelled job, or None if it was unknown
+        """
+        job = self.pop(job_id)
+        if job is None:
+            return None
+        job.cancelled = True
+        if job._future.cancel():
+            job.finished_at = time.time()
+            job.status = CANCELLED
+        logger.info("Cancelled %s job %s (%s)", job.name, job.id[:8], job.status)
+        return job
+
+    def _prune(self):
+        cutoff = time.time() - self.keep_seconds
+        with self._lock:
+            for job_id in [
+                job_id
+                for job_id, job in self._jobs.items()
+                if job.done and job.finished_at < cutoff
+            ]:
+                del self._jobs[job_id]
+
+    def stats(self):
+        """
+        Returns:
+            dict: Number of known jobs per status
+        """
+        with self._lock:
+            jobs = list(self._jobs.values())
+        counts = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+        for job in jobs:
+            counts[job.status] += 1
+        return counts
+
+
+# Shared by every session on this server
+grading_jobs = JobQueue()
@@ -0,0 +1,202 @@
+import time
+from dataclasses import dataclass
+
+import numpy as np
+from PIL import Image
+
+from graph import overlay_grid_on_image
+from tracing import set_attribute, span
+from utils import image_to_bytes, load_image
+
+# How the image sent to Gemini is prepared. "auto" values are picked per sheet
+# from its ink density and colour; set them explicitly to pin a trade-off.
+PAYLOAD_SETTINGS = {
+    "format": "auto",  # "auto", "JPEG", "WEBP" or "PNG"
+    "quality": "auto",  # 1-95 for JPEG/WEBP, or "auto"
+    "grayscale": "auto",  # True, False or "auto"
+    "max_width": 1024,  # Width used for the densest sheets (never upscaled)
+    "min_width": 768,  # Width used for the sparsest sheets
+}
+
+MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+# Ink covering this fraction of the sheet counts as fully dense
+DENSE_INK_FRACTION = 0.08
+# Below this fraction of coloured ink pixels the sheet is sent in grayscale
+COLOUR_INK_FRACTION = 0.05
+# Quality range for lossy formats, from sparse to dense sheets
+MIN_QUALITY = 80
+MAX_QUALITY = 90
+# Width of the thumbnail the sheet is analysed on
+ANALYSIS_WIDTH = 256
+
+
+@dataclass(frozen=True)
+class Payload:
+    """
+    The encoded, grid-overlaid image sent to the model.
+
+    `scale` is payload pixels per input pixel; coordinates returned by the model
+    are divided by it to land on the input image.
+    """
+
+    data: bytes
+    mime_type: str
+    format: str
+    quality: int  # None for PNG
+    grayscale: bool
+    width: int
+    height: int
+    scale: float
+    ink_density: float
+    encode_ms: float
+
+    def describe(self):
+        """Summary of the encoding choices (for traces and batch summaries)."""
+        return {
+            "payload_format": self.format,
+            "payload_quality": self.quality,
+            "payload_grayscale": self.grayscale,
+            "payload_size": f"{self.width}x{self.height}",
+            "payload_bytes": len(self.data),
+            "ink_density": round(self.ink_density, 4),
+        }
+
+
+def analyse_sheet(image):
+    """
+    Measure how much ink is on the sheet and whether any of it is coloured.
+
+    Works on a small thumbnail, so it costs a few milliseconds at most.
+
+    Returns:
+        tuple: (ink_density, colour_fraction), both between 0 and 1
+    """
+    thumb = image.convert("RGB")
+    thumb.thumbnail((ANALYSIS_WIDTH, ANALYSIS_WIDTH * 8))
+    gray = np.asarray(thumb.convert("L"))
+    # Ink is anything clearly darker than the paper (the median pixel)
+    ink = gray < np.median(gray) * 0.6
+    ink_count = int(ink.sum())
+    if ink_count == 0:
+        return 0.0, 0.0
+    saturation = np.asarray(thumb.convert("HSV"))[..., 1]
+    colour_count = int((saturation[ink] > 80).sum())
+    return ink_count / ink.size, colour_count / ink_count
+
+
+def choose_settings(image, settings=None):
+    """
+    Resolve the "auto" payload settings for this sheet.
+
+    Dense sheets keep more resolution and quality so small handwriting stays
+    legible; sparse ones are sent smaller. Sheets without coloured ink are sent
+    in grayscale.
+
+    Returns:
+        dict: format, quality, grayscale and width, plus the measured ink_density
+    """
+    settings = {**PAYLOAD_SETTINGS, **(settings or {})}
+    ink_density, colour_fraction = analyse_sheet(image)
+    density = min(ink_density / DENSE_INK_FRACTION, 1.0)
+
+    image_format = settings["format"]
+    if image_format == "auto":
+        # JPEG is about as small as WebP for photos and encodes ~10x faster
+        image_format = "JPEG"
+    image_format = image_format.upper()
+    if image_format not in MIME_TYPES:
+        raise ValueError(f"Unsupported payload format '{settings['format']}'")
+
+    quality = settings["quality"]
+    if image_format == "PNG":
+        quality = None  # Lossless
+    elif quality == "auto":
+        quality = round(MIN_QUALITY + (MAX_QUALITY - MIN_QUALITY) * density)
+
+    grayscale = settings["grayscale"]
+    if grayscale == "auto":
+        grayscale = colour_fraction < COLOUR_INK_FRACTION
+
+    width = round(
+        settings["min_width"]
+        + (settings["max_width"] - settings["min_width"]) * density
+    )
+    return {
+        "format": image_format,
+        "quality": quality,
+        "grayscale": grayscale,
+        "width": min(width, image.width),
+        "ink_density": ink_density,
+    }
+
+
+def encode(image, image_format, quality, grayscale):
+    """
+    Returns:
+        tuple: (encoded bytes, MIME type)
+    """
+    image = image.convert("L" if grayscale else "RGB")
+    params = {}
+    if image_format == "JPEG":
+        params = {"quality": quality, "optimize": True}
+    elif image_format == "WEBP":
+        params = {"quality": quality, "method": 2}
+    return (
+        image_to_bytes(image, format=image_format, **params),
+        MIME_TYPES[image_format],
+    )
+
+
+def build_payload(image, grid_settings, settings=None):
+    """
+    Resize the sheet for the model, overlay the coordinate grid and encode it.
+
+    The grid is drawn after resizing, so its labels match the pixels the model
+    sees and stay legible.
+
+    Args:
+        image: PIL image, encoded bytes or path of the (cropped) sheet
+        grid_settings (dict): Keyword arguments for overlay_grid_on_image
+        settings (dict): Overrides for PAYLOAD_SETTINGS
+
+    Returns:
+        Payload: The encoded image and how it was produced
+    """
+    img = load_image(image)
+    with span("payload", width=img.width, height=img.height) as payload_span:
+        start = time.perf_counter()
+        chosen = choose_settings(img, settings)
+
+        scale = chosen["width"] / img.width
+        if chosen["width"] != img.width:
+            height = max(1, round(img.height * scale))
+            img = img.resize((chosen["width"], height), Image.LANCZOS)
+
+        with span("grid_overlay", width=img.width, height=img.height):
+            grid_image = overlay_grid_on_image(img, **grid_settings)
+        if grid_image is None:
+            raise Exception("Could not add the grid overlay to the image.")
+
+        data, mime_type = encode(
+            grid_image, chosen["format"], chosen["quality"], chosen["grayscale"]
+        )
+        payload = Payload(
+            data=data,
+            mime_type=mime_type,
+            format=chosen["format"],
+            quality=chosen["quality"],
+            grayscale=chosen["grayscale"],
+            width=grid_image.width,
+            height=grid_image.height,
+            scale=scale,
+            ink_density=chosen["ink_density"],
+            encode_ms=(time.perf_counter() - start) * 1000,
+        )
+        for key, value in payload.describe().items():
+            payload_span.set(key, value)
+            if key != "payload_bytes":
+                # Encoding choices also go on the request trace (upload bytes
+                # are added up there by run_model)
+                set_attribute(key, value)
+    return payload
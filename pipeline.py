@@ -0,0 +1,249 @@
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+from cache import response_cache
+from counter import refund_quota, reserve_quota
+from geminigen import generate, parse_response, response_cache_key
+from results import ResponseValidationError
+from singleflight import SingleFlight
+from tracing import increment_attribute, set_attribute, span
+
+logger = logging.getLogger(__name__)
+
+INPUT_PROMPT = "grade this. include unanswered problems. **The 'correctness' property you return should be true if the student answer is correct for that question and false if incorrect**. *Notice that there is a graph overlay. Use that to help you approximate coordinates of answers*"
+
+# Grid overlay settings shared by the app and the batch CLI
+GRID_SETTINGS = {
+    "grid_spacing": 50,
+    "grid_opacity": 50,
+    "label_inset": 10,
+    "label_font_size": 14,
+}
+
+
+# Model calls in progress in this process, by response cache key
+model_flights = SingleFlight()
+
+# The ledger that model calls in the current context are charged to, if any
+_current_ledger = contextvars.ContextVar("quota_ledger", default=None)
+# Semaphore that model calls in the current context wait for, if any
+_call_limit = contextvars.ContextVar("model_call_limit", default=None)
+
+
+class QuotaExceededError(Exception):
+    """Raised when the global daily or monthly Gemini quota is used up."""
+
+
+def reserve_slot():
+    """
+    Take one slot of the global quota in a single atomic round trip.
+
+    Raises:
+        QuotaExceededError: If the daily or monthly limit is reached
+
+    Returns:
+        dict: The reservation from reserve_quota (pass it to refund_quota on failure)
+    """
+    # The quota check and the counter update are one atomic round trip
+    with span("quota") as quota_span:
+        reservation = reserve_quota()
+        quota_span.set("reserved", reservation["reserved"])
+        quota_span.set("daily_remaining", reservation["daily_remaining"])
+    logger.debug("Quota reservation: %s", reservation)
+    if not reservation["reserved"]:
+        # Rate Limit Hit
+        if reservation["daily_remaining"] <= 0:
+            raise QuotaExceededError(
+                "Global Daily rate limit reached. Please contact developer at jorgezavala.um@gmail.com if you would like to try this app."
+            )
+        else:
+            raise QuotaExceededError(
+                "Global Monthly rate limit reached. Please contact developer at jorgezavala.um@gmail.com if you would like to try this app."
+            )
+    return reservation
+
+
+class GradingCancelled(Exception):
+    """Raised when work charged to a cancelled QuotaLedger tries to call the model."""
+
+
+class QuotaLedger:
+    """
+    The quota slots taken by one piece of work that may be thrown away (a
+    speculative grading), so they can all be given back if it is.
+
+    Model calls made inside charge_to(ledger) record their slot here once they
+    succeed. After cancel(), recorded slots have been refunded, a call still
+    running refunds its slot when it finishes (and its result isn't cached), and
+    new calls aren't made. Calls charged to a ledger never coalesce with
+    callers outside it.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self._reservations = []
+        self._lock = threading.Lock()
+
+    def add(self, reservation):
+        """
+        Returns:
+            bool: False if the ledger was cancelled (the caller refunds the slot)
+        """
+        with self._lock:
+            if self.cancelled:
+                return False
+            self._reservations.append(reservation)
+            return True
+
+    def cancel(self):
+        """
+        Refund every slot charged so far.
+
+        Returns:
+            int: Number of slots refunded
+        """
+        with self._lock:
+            self.cancelled = True
+            reservations, self._reservations = self._reservations, []
+        for reservation in reservations:
+            _refund(reservation)
+        return len(reservations)
+
+
+@contextmanager
+def charge_to(ledger):
+    """Record the quota slots of model calls made inside this block on `ledger`."""
+    token = _current_ledger.set(ledger)
+    try:
+        yield ledger
+    finally:
+        _current_ledger.reset(token)
+
+
+@contextmanager
+def limit_model_calls(semaphore):
+    """
+    Make model calls inside this block wait for `semaphore`, including calls
+    from workers that copy this context (the bands of a tiled sheet). Callers
+    that grade several sheets at once share one semaphore to bound the total
+    number of calls in flight.
+    """
+    token = _call_limit.set(semaphore)
+    try:
+        yield semaphore
+    finally:
+        _call_limit.reset(token)
+
+
+def _refund(reservation):
+    with span("quota.refund"):
+        refund_quota(reservation)
+
+
+def _call_model(image_data, mime_type, prompt_text, api_key, cache_key, on_question):
+    # One charged model call; run once per in-flight cache key by run_model
+    ledger = _current_ledger.get()
+    if ledger is not None and ledger.cancelled:
+        raise GradingCancelled("Grading was cancelled before the model was called.")
+    reservation = reserve_slot()
+
+    # Upload size and model latency are recorded on the request trace (summed
+    # over the model calls of a tiled sheet)
+    increment_attribute("upload_bytes", len(image_data))
+    set_attribute("upload_mime_type", mime_type)
+    start = time.perf_counter()
+
+    # Give the slot back if the call fails or returns nothing usable
+    try:
+        with _call_limit.get() or nullcontext():
+            result = generate(
+                image=image_data,
+                prompt_text=prompt_text,
+                api_key=api_key,
+                mime_type=mime_type,
+                on_question=on_question,
+            )
+    except Exception:
+        _refund(reservation)
+        raise
+    finally:
+        increment_attribute("model_ms", round((time.perf_counter() - start) * 1000, 1))
+    if result is None:
+        _refund(reservation)
+        raise Exception("Gemini did not return any grading data. Please try again.")
+    if ledger is not None and not ledger.add(reservation):
+        # Cancelled while the call was running: the slot is given back, so the
+        # result must not reach anyone else through the cache either
+        logger.info("Refunding a call that finished after it was cancelled")
+        _refund(reservation)
+        return result
+
+    # Only complete, validated responses are cached
+    response_cache.set(cache_key, result.to_json())
+    return result
+
+
+def run_model(payload, api_key, prompt_text=INPUT_PROMPT, on_question=None):
+    """
+    Get grading data for an encoded payload (see payload.build_payload), from
+    the cache if possible.
+
+    The payload bytes are used for both the cache key and the model request.
+    Identical sheets (e.g. after "Try Again") are served from the response cache
+    without calling the model or spending quota, and identical requests that
+    arrive while one is still in flight (several tabs or teachers submitting the
+    same sheet) wait for that call and share its result and its single quota
+    slot. `on_question` is called with each Question as soon as it is available
+    (all at once on a cache hit).
+
+    Coordinates in the result (and passed to `on_question`) are mapped back from
+    the payload's resolution to the image it was built from.
+
+    Returns:
+        GradingResult: Validated grading data
+    """
+    image_data, mime_type = payload.data, payload.mime_type
+    to_input = 1 / payload.scale
+
+    # Questions arrive in payload coordinates
+    on_payload_question = on_question
+    if on_question is not None and to_input != 1:
+
+        def on_payload_question(question):
+            on_question(question.scaled(to_input))
+
+    cache_key = response_cache_key(image_data, prompt_text)
+    with span("cache.lookup") as lookup_span:
+        cached = response_cache.get(cache_key)
+        lookup_span.set("hit", cached is not None)
+    if cached is not None:
+        try:
+            result = parse_response(cached)
+            logger.info("Response cache hit for %s", cache_key[:12])
+            if on_payload_question is not None:
+                for question in result.questions:
+                    on_payload_question(question)
+            return result.scaled(to_input)
+        except ResponseValidationError:
+            # Entries written in an older format are treated as misses
+            pass
+
+    # Calls charged to a ledger may be refunded (or never made) if it is
+    # cancelled, so they never share a flight with callers outside the ledger
+    ledger = _current_ledger.get()
+    flight_key = cache_key if ledger is None else (cache_key, id(ledger))
+    result, coalesced = model_flights.run(
+        flight_key,
+        lambda publish: _call_model(
+            image_data, mime_type, prompt_text, api_key, cache_key, publish
+        ),
+        on_item=on_payload_question,
+    )
+    if coalesced:
+        # Another session sent the same sheet first; nothing was charged here
+        logger.info("Coalesced with in-flight request %s", cache_key[:12])
+        set_attribute("coalesced", True)
+    return result.scaled(to_input)
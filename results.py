@@ -0,0 +1,268 @@
+import json
+import pprint
+from dataclasses import dataclass, replace
+from functools import cached_property
+
+
+class ResponseValidationError(ValueError):
+    """Raised when model output does not match the declared response schema."""
+
+
+# JSON types accepted for each schema type name
+_SCHEMA_TYPES = {
+    "OBJECT": (dict,),
+    "ARRAY": (list,),
+    "STRING": (str,),
+    "INTEGER": (int,),
+    "NUMBER": (int, float),
+    "BOOLEAN": (bool,),
+}
+
+
+def _type_name(schema):
+    # Schema types are str enums; fall back to the raw value for plain strings
+    return str(getattr(schema.type, "value", schema.type)).upper()
+
+
+def validate(value, schema, path="response"):
+    """
+    Check parsed JSON against a genai Schema (type, required, properties, items).
+
+    Raises:
+        ResponseValidationError: On the first mismatch, naming the offending path
+    """
+    if schema.type is None:
+        return
+    type_name = _type_name(schema)
+    expected = _SCHEMA_TYPES.get(type_name)
+    if expected is None:
+        return
+    # bool is a subclass of int, but true/false are not valid integers
+    if not isinstance(value, expected) or (
+        isinstance(value, bool) and type_name != "BOOLEAN"
+    ):
+        raise ResponseValidationError(
+            f"{path}: expected {type_name.lower()}, got {type(value).__name__}"
+        )
+
+    if type_name == "OBJECT":
+        for key in schema.required or []:
+            if key not in value:
+                raise ResponseValidationError(f"{path}: missing '{key}'")
+        for key, property_schema in (schema.properties or {}).items():
+            if key in value:
+                validate(value[key], property_schema, f"{path}.{key}")
+    elif type_name == "ARRAY" and schema.items is not None:
+        for i, item in enumerate(value):
+            validate(item, schema.items, f"{path}[{i}]")
+
+
+@dataclass(frozen=True)
+class Question:
+    question: str
+    student_answer: str
+    correct_answer: str
+    correctness: bool
+    answer_written: bool
+    x: int
+    y: int
+
+    @property
+    def coords(self):
+        return (self.x, self.y)
+
+    def scaled(self, factor):
+        """Copy with the answer coordinates multiplied by `factor`."""
+        return replace(self, x=round(self.x * factor), y=round(self.y * factor))
+
+    def translated(self, dx, dy):
+        """Copy with the answer coordinates moved by (dx, dy)."""
+        return replace(self, x=self.x + dx, y=self.y + dy)
+
+    @classmethod
+    def from_dict(cls, data):
+        coordinates = data["coordinates_of_answer"]
+        return cls(
+            question=data.get("question", ""),
+            student_answer=data.get("student_answer", ""),
+            correct_answer=data.get("correct_answer", ""),
+            correctness=data["correctness"],
+            answer_written=data.get("answer_written", False),
+            x=coordinates["x_coordinate"],
+            y=coordinates["y_coordinate"],
+        )
+
+    def to_dict(self):
+        return {
+            "question": self.question,
+            "student_answer": self.student_answer,
+            "correct_answer": self.correct_answer,
+            "correctness": self.correctness,
+            "answer_written": self.answer_written,
+            "coordinates_of_answer": {"x_coordinate": self.x, "y_coordinate": self.y},
+        }
+
+
+@dataclass(frozen=True)
+class GradingResult:
+    questions: tuple
+    total_amount_of_questions: int
+    correct_answers: int
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            questions=tuple(Question.from_dict(q) for q in data["questions"]),
+            total_amount_of_questions=data["total_amount_of_questions"],
+            correct_answers=data["correct_answers"],
+        )
+
+    @classmethod
+    def from_json(cls, text, schema=None):
+        """
+        Parse model JSON output, validating it against `schema` when given.
+        """
+        try:
+            data = json.loads(text)
+        except json.JSONDecodeError as e:
+            raise ResponseValidationError(f"response is not valid JSON: {e}") from e
+        if schema is not None:
+            validate(data, schema)
+        return cls.from_dict(data)
+
+    def scaled(self, factor):
+        """Copy with every answer coordinate multiplied by `factor`."""
+        if factor == 1:
+            return self
+        return replace(self, questions=tuple(q.scaled(factor) for q in self.questions))
+
+    def translated(self, dx, dy):
+        """Copy with every answer coordinate moved by (dx, dy)."""
+        if dx == 0 and dy == 0:
+            return self
+        return replace(
+            self, questions=tuple(q.translated(dx, dy) for q in self.questions)
+        )
+
+    def to_dict(self):
+        return {
+            "questions": [q.to_dict() for q in self.questions],
+            "total_amount_of_questions": self.total_amount_of_questions,
+            "correct_answers": self.correct_answers,
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), separators=(",", ":"))
+
+    @cached_property
+    def python_literal(self):
+        """Python-literal text of the result, built on first use (for downloads)."""
+        return pprint.pformat(self.to_dict(), sort_dicts=False)
+
+
+class QuestionStreamParser:
+    """
+    Incremental parser for the streamed response.
+
+    Feed it text chunks as they arrive; each call returns the `questions[]`
+    entries whose closing brace arrived in that chunk. The rest of the document
+    is parsed and validated as usual once the stream ends.
+    """
+
+    def __init__(self, schema=None):
+        # Schema for a single question, taken from the response schema
+        self.item_schema = None
+        if schema is not None:
+            self.item_schema = schema.properties["questions"].items
+        self._text = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._last_key = None
+        self._in_questions = False
+        self._item_start = None
+        self.count = 0
+
+    @property
+    def text(self):
+        return self._text
+
+    def feed(self, chunk):
+        """
+        Returns:
+            list: Questions completed by this chunk
+        """
+        self._text += chunk
+        completed = []
+        text = self._text
+        for i in range(self._pos, len(text)):
+            char = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        # Top-level strings are keys (all values there are numbers)
+                        self._last_key = text[self._string_start + 1 : i]
+                continue
+
+            if char == '"':
+                self._in_string = True
+                self._string_start = i
+            elif char in "{[":
+                if self._depth == 1 and char == "[" and self._last_key == "questions":
+                    self._in_questions = True
+                elif self._in_questions and self._depth == 2 and char == "{":
+                    self._item_start = i
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._in_questions and self._depth == 2 and char == "}":
+                    completed.append(self._parse_item(text[self._item_start : i + 1]))
+                    self._item_start = None
+                elif self._in_questions and self._depth == 1:
+                    self._in_questions = False
+        self._pos = len(text)
+        return completed
+
+    def _parse_item(self, item_text):
+        try:
+            data = json.loads(item_text)
+        except json.JSONDecodeError as e:
+            raise ResponseValidationError(f"question is not valid JSON: {e}") from e
+        if self.item_schema is not None:
+            validate(data, self.item_schema, f"response.questions[{self.count}]")
+        self.count += 1
+        return Question.from_dict(data)
+
+
+@dataclass(frozen=True)
+class DocumentResult:
+    """Grading data for a multi-page submission, one GradingResult per page."""
+
+    pages: tuple
+
+    @property
+    def total_amount_of_questions(self):
+        return sum(page.total_amount_of_questions for page in self.pages)
+
+    @property
+    def correct_answers(self):
+        return sum(page.correct_answers for page in self.pages)
+
+    def to_dict(self):
+        return {
+            "pages": [page.to_dict() for page in self.pages],
+            "total_amount_of_questions": self.total_amount_of_questions,
+            "correct_answers": self.correct_answers,
+        }
+
+    @cached_property
+    def python_literal(self):
+        """Python-literal text of the result, built on first use (for downloads)."""
+        return pprint.pformat(self.to_dict(), sort_dicts=False)
@@ -0,0 +1,111 @@
+import threading
+
+
+class _Flight:
+    """One in-flight call and everything it has published so far."""
+
+    def __init__(self):
+        self.items = []
+        self.done = False
+        self.result = None
+        self.error = None
+        self.waiters = 0
+        self.condition = threading.Condition()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one.
+
+    The first caller for a key (the leader) runs the function; callers that
+    arrive while it is running wait for it and get the same result or
+    exception. Items the leader publishes while running (e.g. streamed
+    questions) are replayed to every waiter on the waiter's own thread.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.coalesced = 0
+
+    def run(self, key, func, on_item=None):
+        """
+        Run `func(publish)` once for all concurrent callers with this `key`.
+
+        `func` receives a publish(item) callable for partial results; every
+        caller's `on_item` is called with each published item, in order.
+
+        Returns:
+            tuple: (result, shared), where shared is True if this caller
+                waited on another caller's flight
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+                self.calls += 1
+            else:
+                flight.waiters += 1
+                self.coalesced += 1
+
+        if leader:
+            return self._lead(key, flight, func, on_item), False
+        return self._wait(flight, on_item), True
+
+    def _lead(self, key, flight, func, on_item):
+        def publish(item):
+            with flight.condition:
+                flight.items.append(item)
+                flight.condition.notify_all()
+            if on_item is not None:
+                on_item(item)
+
+        try:
+            flight.result = func(publish)
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            # Later callers start a new flight (or find the result cached)
+            with self._lock:
+                del self._flights[key]
+            with flight.condition:
+                flight.done = True
+                flight.condition.notify_all()
+
+    def _wait(self, flight, on_item):
+        seen = 0
+        while True:
+            with flight.condition:
+                flight.condition.wait_for(
+                    lambda: flight.done or len(flight.items) > seen
+                )
+                new_items = flight.items[seen:]
+                done = flight.done
+            seen += len(new_items)
+            if on_item is not None:
+                for item in new_items:
+                    on_item(item)
+            if done and seen == len(flight.items):
+                break
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def stats(self):
+        """
+        Returns:
+            dict: Flights in progress, callers waiting on them, leader calls
+                and coalesced (saved) calls since start
+        """
+        with self._lock:
+            return {
+                "in_flight": len(self._flights),
+                "waiting": sum(f.waiters for f in self._flights.values()),
+                "calls": self.calls,
+                "coalesced": self.coalesced,
+            }
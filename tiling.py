@@ -0,0 +1,223 @@
+import contextvars
+import logging
+import math
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+from counter import add_mongo_timing, get_mongo_timing, reset_mongo_timing
+from payload import build_payload
+from pipeline import GRID_SETTINGS, INPUT_PROMPT, run_model
+from results import GradingResult
+from tracing import set_attribute, span
+from utils import load_image
+
+logger = logging.getLogger(__name__)
+
+# Sheets taller than this many times their width are graded in bands
+TILE_ASPECT_RATIO = 2.0
+
+TILE_SETTINGS = {
+    "band_height": 1280,  # Height of each band in input pixels
+    "overlap": 160,  # Minimum overlap between neighbouring bands
+    "max_workers": 4,  # Concurrent model calls per sheet
+    "duplicate_distance": 48,  # Answers closer than this (px) in an overlap match
+}
+
+
+def needs_tiling(image, settings=None):
+    """True if the sheet is tall enough to be graded band by band."""
+    settings = {**TILE_SETTINGS, **(settings or {})}
+    return (
+        image.height > image.width * TILE_ASPECT_RATIO
+        and image.height > settings["band_height"]
+    )
+
+
+def split_bands(height, band_height, overlap):
+    """
+    Split [0, height) into evenly spaced bands that overlap by at least
+    `overlap` pixels.
+
+    Returns:
+        list: (top, bottom) pairs from top to bottom
+    """
+    if height <= band_height:
+        return [(0, height)]
+    count = math.ceil((height - overlap) / (band_height - overlap))
+    step = (height - band_height) / (count - 1)
+    return [(round(i * step), round(i * step) + band_height) for i in range(count)]
+
+
+def _edge_distance(question, band, height):
+    # How far the answer is from the nearest edge that cuts the sheet; answers
+    # near a cut are the ones a band may have seen only partly
+    top, bottom = band
+    distances = []
+    if top > 0:
+        distances.append(question.y - top)
+    if bottom < height:
+        distances.append(bottom - question.y)
+    return min(distances) if distances else math.inf
+
+
+def _is_duplicate(a, b, max_distance):
+    return abs(a.x - b.x) <= max_distance and abs(a.y - b.y) <= max_distance
+
+
+def merge_bands(band_results, bands, height, max_distance):
+    """
+    Merge per-band results (already in full-image coordinates) into one.
+
+    An answer reported by two neighbouring bands inside their overlap is kept
+    once, from the band where it sits furthest from the cut.
+
+    Returns:
+        GradingResult: All questions ordered top to bottom
+    """
+    merged = []  # (question, band index)
+    for index, result in enumerate(band_results):
+        band = bands[index]
+        for question in result.questions:
+            duplicate = None
+            for i, (kept, kept_index) in enumerate(merged):
+                if kept_index == index - 1 and _is_duplicate(
+                    question, kept, max_distance
+                ):
+                    duplicate = i
+                    break
+            if duplicate is None:
+                merged.append((question, index))
+                continue
+            kept, kept_index = merged[duplicate]
+            if _edge_distance(question, band, height) > _edge_distance(
+                kept, bands[kept_index], height
+            ):
+                merged[duplicate] = (question, index)
+
+    questions = tuple(
+        sorted((question for question, _ in merged), key=lambda q: (q.y, q.x))
+    )
+    return GradingResult(
+        questions=questions,
+        total_amount_of_questions=len(questions),
+        correct_answers=sum(1 for q in questions if q.correctness),
+    )
+
+
+def _grade_band(index, band_image, top, api_key, prompt_text, grid_settings, events):
+    # Runs on a worker thread: grade one band and report its questions (in
+    # full-image coordinates) through the events queue
+    reset_mongo_timing()
+
+    def on_band_question(question):
+        events.put(("question", index, question.translated(0, top)))
+
+    try:
+        with span("band", index=index, top=top, height=band_image.height):
+            payload = build_payload(band_image, grid_settings)
+            result = run_model(
+                payload,
+                api_key=api_key,
+                prompt_text=prompt_text,
+                on_question=on_band_question,
+            )
+        return result.translated(0, top)
+    finally:
+        events.put(("timing", index, get_mongo_timing()))
+
+
+def run_tiled(
+    image,
+    api_key,
+    prompt_text=INPUT_PROMPT,
+    on_question=None,
+    grid_settings=GRID_SETTINGS,
+    settings=None,
+):
+    """
+    Grade a tall sheet as overlapping horizontal bands with concurrent model
+    calls, then merge the bands into one result in full-image coordinates.
+
+    Each band gets its own grid overlay and payload, and goes through run_model
+    (so each band is cached and charged to the quota separately). `on_question`
+    is called on the calling thread as answers stream in from any band; answers
+    seen twice in an overlap are only reported once.
+
+    Returns:
+        GradingResult: Merged grading data
+    """
+    settings = {**TILE_SETTINGS, **(settings or {})}
+    img = load_image(image)
+    bands = split_bands(img.height, settings["band_height"], settings["overlap"])
+    set_attribute("bands", len(bands))
+    logger.info("Grading %dx%d sheet in %d bands", img.width, img.height, len(bands))
+
+    events = queue.Queue()
+    streamed = []  # (question, band index) already passed to on_question
+    with ThreadPoolExecutor(max_workers=settings["max_workers"]) as executor:
+        futures = [
+            # Each worker gets its own copy of the context, so its spans land
+            # in the current request trace
+            executor.submit(
+                contextvars.copy_context().run,
+                _grade_band,
+                index,
+                img.crop((0, top, img.width, bottom)),
+                top,
+                api_key,
+                prompt_text,
+                grid_settings,
+                events,
+            )
+            for index, (top, bottom) in enumerate(bands)
+        ]
+
+        # Relay worker events on this thread (Streamlit can only draw from here)
+        while not (all(f.done() for f in futures) and events.empty()):
+            try:
+                kind, index, value = events.get(timeout=0.05)
+            except queue.Empty:
+                continue
+            if kind == "timing":
+                add_mongo_timing(value)
+            elif on_question is not None:
+                if not any(
+                    abs(index - seen_index) == 1
+                    and _is_duplicate(value, seen, settings["duplicate_distance"])
+                    for seen, seen_index in streamed
+                ):
+                    streamed.append((value, index))
+                    on_question(value)
+
+        band_results = [future.result() for future in futures]
+
+    return merge_bands(band_results, bands, img.height, settings["duplicate_distance"])
+
+
+def run_sheet(
+    image,
+    api_key,
+    prompt_text=INPUT_PROMPT,
+    on_question=None,
+    grid_settings=GRID_SETTINGS,
+):
+    """
+    Get grading data for a whole (cropped) sheet: tall sheets are tiled into
+    bands, everything else is sent as a single payload.
+
+    Returns:
+        GradingResult: Validated grading data in the sheet's coordinates
+    """
+    img = load_image(image)
+    if needs_tiling(img):
+        return run_tiled(
+            img,
+            api_key,
+            prompt_text=prompt_text,
+            on_question=on_question,
+            grid_settings=grid_settings,
+        )
+    payload = build_payload(img, grid_settings)
+    return run_model(
+        payload, api_key=api_key, prompt_text=prompt_text, on_question=on_question
+    )
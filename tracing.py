@@ -0,0 +1,246 @@
+import contextvars
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+# Number of finished request traces kept for the performance panel
+TRACE_HISTORY = 20
+
+# Number of recent Streamlit script reruns whose wall time is kept
+RERUN_HISTORY = 100
+
+# Log level for the app's own modules, e.g. AIGRADER_LOG_LEVEL=DEBUG
+LOG_LEVEL_ENV = "AIGRADER_LOG_LEVEL"
+DEFAULT_LOG_LEVEL = "WARNING"
+APP_LOGGERS = (
+    "app",
+    "batch",
+    "cache",
+    "counter",
+    "crop",
+    "fonts",
+    "geminigen",
+    "grade",
+    "graph",
+    "ingest",
+    "jobs",
+    "pipeline",
+    "tiling",
+)
+
+# The trace of the request running in the current thread / task
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+_recent_traces = deque(maxlen=TRACE_HISTORY)
+_recent_lock = threading.Lock()
+_rerun_times = deque(maxlen=RERUN_HISTORY)
+
+
+class Span:
+    """One timed stage of a request, with free-form attributes."""
+
+    __slots__ = ("name", "start", "end", "attributes")
+
+    def __init__(self, name, start, attributes):
+        self.name = name
+        self.start = start
+        self.end = None
+        self.attributes = attributes
+
+    @property
+    def duration_ms(self):
+        if self.end is None:
+            return None
+        return (self.end - self.start) * 1000
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+
+class _NoopSpan:
+    """Returned by span() when no trace is active, so callers never check."""
+
+    __slots__ = ()
+
+    def set(self, key, value):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    """
+    All spans recorded for one request (e.g. one process_image call).
+
+    Spans are flat and ordered by start time; nested spans simply overlap their
+    parent.
+    """
+
+    def __init__(self, name, attributes=None):
+        self.name = name
+        self.started_at = datetime.now()
+        self.start = time.perf_counter()
+        self.end = None
+        self.attributes = dict(attributes or {})
+        self.spans = []
+        self.error = None
+        self._lock = threading.Lock()
+
+    @property
+    def duration_ms(self):
+        end = self.end if self.end is not None else time.perf_counter()
+        return (end - self.start) * 1000
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def increment(self, key, amount):
+        with self._lock:
+            self.attributes[key] = self.attributes.get(key, 0) + amount
+
+    def add_span(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def to_rows(self):
+        """
+        Returns:
+            list: One dict per span (stage, start and duration in ms, attributes)
+        """
+        rows = []
+        for span in sorted(self.spans, key=lambda s: s.start):
+            duration = span.duration_ms
+            rows.append(
+                {
+                    "stage": span.name,
+                    "start_ms": round((span.start - self.start) * 1000, 1),
+                    "duration_ms": None if duration is None else round(duration, 1),
+                    "attributes": ", ".join(
+                        f"{key}={value}" for key, value in span.attributes.items()
+                    ),
+                }
+            )
+        return rows
+
+
+def current_trace():
+    """Return the active Trace, or None outside a traced request."""
+    return _current_trace.get()
+
+
+@contextmanager
+def start_trace(name, **attributes):
+    """
+    Trace everything inside the block as one request.
+
+    The finished trace (including failed ones) is kept in the recent-traces ring
+    buffer shown by the app's performance panel.
+    """
+    trace = Trace(name, attributes)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    except BaseException as e:
+        trace.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        trace.end = time.perf_counter()
+        _current_trace.reset(token)
+        with _recent_lock:
+            _recent_traces.append(trace)
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Time a stage of the current request.
+
+    Yields a span whose attributes can be set inside the block. Without an active
+    trace this is a no-op, so library code can always be instrumented.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield _NOOP_SPAN
+        return
+    current = Span(name, time.perf_counter(), attributes)
+    trace.add_span(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.set("error", type(e).__name__)
+        raise
+    finally:
+        current.end = time.perf_counter()
+
+
+def set_attribute(key, value):
+    """Set an attribute on the current trace (ignored outside a trace)."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.set(key, value)
+
+
+def increment_attribute(key, amount):
+    """
+    Add to a numeric attribute of the current trace, e.g. bytes uploaded by
+    several concurrent model calls (ignored outside a trace).
+    """
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.increment(key, amount)
+
+
+def recent_traces(limit=TRACE_HISTORY):
+    """
+    Returns:
+        list: Up to `limit` finished traces, newest first
+    """
+    with _recent_lock:
+        traces = list(_recent_traces)
+    return traces[::-1][:limit]
+
+
+def record_rerun(duration_ms):
+    """Record the wall time of one full script rerun."""
+    with _recent_lock:
+        _rerun_times.append(duration_ms)
+
+
+def rerun_stats():
+    """
+    Returns:
+        dict: count, last_ms, median_ms and max_ms over the recent reruns (None
+            before the first one)
+    """
+    with _recent_lock:
+        times = list(_rerun_times)
+    if not times:
+        return None
+    ordered = sorted(times)
+    return {
+        "count": len(times),
+        "last_ms": times[-1],
+        "median_ms": ordered[len(ordered) // 2],
+        "max_ms": ordered[-1],
+    }
+
+
+def configure_logging(level=None):
+    """
+    Set up leveled logging for the app's modules.
+
+    The level comes from `level`, then $AIGRADER_LOG_LEVEL, then WARNING. Debug
+    messages (one per streamed chunk and per drawn mark) use lazy %-formatting,
+    so they cost next to nothing unless enabled.
+    """
+    level = level or os.environ.get(LOG_LEVEL_ENV, DEFAULT_LOG_LEVEL)
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    for name in APP_LOGGERS:
+        logging.getLogger(name).setLevel(level.upper())
@@ -1,5 +1,26 @@
+import io
 import numpy as np
-from PIL import Image, ExifTags
+from PIL import Image
+
+
+def load_image(source):
+    """
+    Return a PIL image for a file path, a bytes buffer or an existing PIL image.
+    """
+    if isinstance(source, Image.Image):
+        return source
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    return Image.open(source)
+
+
+def image_to_bytes(image, format="PNG", **params):
+    """
+    Encode a PIL image in memory and return the encoded bytes.
+    """
+    buffer = io.BytesIO()
+    image.save(buffer, format=format, **params)
+    return buffer.getvalue()
 
 
 def resize_image_width(image, target_width=1024):
@@ -15,47 +36,49 @@ def resize_image_width(image, target_width=1024):
     return resized_image
 
 
-def fix_image_orientation(image):
-    # Fix image orientation based on EXIF data
-    try:
-        # Check if the image has EXIF data
-        if hasattr(image, "_getexif") and image._getexif() is not None:
-            exif = dict(
-                (ExifTags.TAGS.get(k, k), v) for k, v in image._getexif().items()
-            )
-
-            # Check if Orientation tag exists
-            if "Orientation" in exif:
-                orientation = exif["Orientation"]
-
-                # Apply orientation corrections
-                if orientation == 2:
-                    # Horizontal flip
-                    image = image.transpose(Image.FLIP_LEFT_RIGHT)
-                elif orientation == 3:
-                    # Rotate 180 degrees
-                    image = image.transpose(Image.ROTATE_180)
-                elif orientation == 4:
-                    # Vertical flip
-                    image = image.transpose(Image.FLIP_TOP_BOTTOM)
-                elif orientation == 5:
-                    # Transpose (flip horizontally and rotate 90 degrees)
-                    image = image.transpose(Image.FLIP_LEFT_RIGHT).transpose(
-                        Image.ROTATE_90
-                    )
-                elif orientation == 6:
-                    # Rotate 270 degrees
-                    image = image.transpose(Image.ROTATE_270)
-                elif orientation == 7:
-                    # Transverse (flip vertically and rotate 90 degrees)
-                    image = image.transpose(Image.FLIP_TOP_BOTTOM).transpose(
-                        Image.ROTATE_90
-                    )
-                elif orientation == 8:
-                    # Rotate 90 degrees
-                    image = image.transpose(Image.ROTATE_90)
-    except (AttributeError, KeyError, IndexError):
-        # Just return the image if there's any error
-        pass
+# EXIF tag holding the orientation (1-8) of camera photos
+ORIENTATION_TAG = 0x0112
+
 
+def apply_orientation(image, orientation):
+    """Transpose an image so an EXIF `orientation` (1-8) is displayed upright."""
+    # Apply orientation corrections
+    if orientation == 2:
+        # Horizontal flip
+        image = image.transpose(Image.FLIP_LEFT_RIGHT)
+    elif orientation == 3:
+        # Rotate 180 degrees
+        image = image.transpose(Image.ROTATE_180)
+    elif orientation == 4:
+        # Vertical flip
+        image = image.transpose(Image.FLIP_TOP_BOTTOM)
+    elif orientation == 5:
+        # Transpose (flip horizontally and rotate 90 degrees)
+        image = image.transpose(Image.FLIP_LEFT_RIGHT).transpose(Image.ROTATE_90)
+    elif orientation == 6:
+        # Rotate 270 degrees
+        image = image.transpose(Image.ROTATE_270)
+    elif orientation == 7:
+        # Transverse (flip vertically and rotate 90 degrees)
+        image = image.transpose(Image.FLIP_TOP_BOTTOM).transpose(Image.ROTATE_90)
+    elif orientation == 8:
+        # Rotate 90 degrees
+        image = image.transpose(Image.ROTATE_90)
     return image
+
+
+def read_orientation(image):
+    """
+    EXIF orientation of an image, or 1 if it has none.
+
+    Only the first IFD is parsed, not the whole EXIF dictionary.
+    """
+    try:
+        return int(image.getexif().get(ORIENTATION_TAG, 1))
+    except (AttributeError, TypeError, ValueError, OSError):
+        return 1
+
+
+def fix_image_orientation(image):
+    # Fix image orientation based on EXIF data (only the orientation tag is read)
+    return apply_orientation(image, read_orientation(image))